@@ -1,11 +1,17 @@
 #!flask/bin/python
-from flask import Flask, jsonify, request, json, abort
+from flask import Flask, Response, request, json, abort, stream_with_context
+from flask import send_from_directory, url_for
 from flask.ext.sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import default_exceptions
 from werkzeug.exceptions import HTTPException
 from datetime import datetime
 import random
+import querystats
+import encoding
+import compression
+from encoding import jsonify
+from database import Database
 
 #__all__ = ['make_json_app']
 
@@ -48,11 +54,22 @@ def make_json_app(import_name):
 #app = Flask(__name__)
 app = make_json_app(__name__)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+db = Database(app)
+querystats.init_app(app)
+encoding.init_app(app)
+compression.init_app(app)
 
 from models import *
 from parser import *
+from cache import poll_cache
+from conditional import make_etag, not_modified, tag
 import auth
+import codegen
+import export
+import jobs
+import tasks
+import memberimport
+import tally
 import xlprsr
 
 @app.route('/')
@@ -61,6 +78,19 @@ def index():
     return "Hello, world!"
 
 
+# Trade Basic credentials for a short-lived token that can be sent as
+# 'Authorization: Bearer <token>' instead of the password.
+@app.route('/token', methods=['GET', 'POST'])
+@auth.requires_password
+def token():
+    user = auth.get_user()
+    expiration = app.config['TOKEN_EXPIRATION']
+    data = {}
+    data['token'] = user.generate_auth_token(expiration)
+    data['expires_in'] = expiration
+    return jsonify(status='success', data=data)
+
+
 # The /polls endpoint is split into two functions because POST requests require
 # authentication but not GET requests.
 @app.route('/polls', methods=['GET'])
@@ -72,31 +102,61 @@ def get_poll():
         if not organizer:
             abort(404)
         else:
+            etag = make_etag('polls', organizer.id, organizer.updated_on, organizer.polls_version)
+            response = not_modified(etag)
+            if response:
+                return response
+
             # Give the organizer a list of all his polls.
-            polls = Poll.query.filter_by(organizer=organizer).all()
+            polls = Poll.query_serializable().filter_by(organizer=organizer).all()
             data = {}
             data['polls'] = []
             for poll in polls:
                 data['polls'].append(poll.to_dict())
-            return jsonify(status='success', data=data)
+            return tag(jsonify(status='success', data=data), etag)
 
-    # Look up the given vote code and use it to retrieve the poll.
-    code = Code.query.filter_by(code=vote_code).first()
-    if not code:
+    # Look up the given vote code, whether it has been used and the version of
+    # its poll in a single query.
+    row = Code.lookup(vote_code).first()
+    if not row:
         data = {}
         data['code'] = 'Invalid voting code'
         return jsonify(status='fail', data=data), 404
+    poll_id, version, created_on, vote_id = row
+    poll_version = (version, created_on)
     # Has the code already been used?
-    if code.vote != None:
+    if vote_id != None:
         data = {}
-        data['code'] = 'This voting code has already been used'
+        data['code'] = CODE_USED_ERROR
         return jsonify(status='fail', data=data), 403
-    poll = code.poll
-    if not poll:
-        abort(404)
-    data = {}
-    data['poll'] = poll.to_dict()
-    return jsonify(status='success', data=data), 200
+
+    etag = make_etag('poll', poll_id, version, created_on)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    # Every voter of a poll gets the same payload, so serialize it only once.
+    payload = poll_cache.get(poll_id, poll_version)
+    if payload is None:
+        poll = Poll.query_serializable().get(poll_id)
+        if not poll:
+            abort(404)
+        data = {}
+        data['poll'] = poll.to_dict()
+        payload = encoding.dumps(dict(status='success', data=data))
+        poll_cache.set(poll_id, poll_version, payload)
+    response = tag(app.response_class(payload, mimetype='application/json'), etag)
+
+    # Compress the payload once per poll version instead of once per voter.
+    content_encoding = compression.negotiate()
+    if content_encoding and len(payload) >= app.config['COMPRESS_MIN_SIZE']:
+        body = poll_cache.get_encoded(poll_id, poll_version, content_encoding)
+        if body is None:
+            body = compression.compress(payload, content_encoding)
+            poll_cache.set_encoded(poll_id, poll_version, content_encoding, body)
+        response.set_data(body)
+        compression.set_content_encoding(response, content_encoding)
+    return response, 200
 
 @app.route('/polls', methods=['POST'])
 @auth.requires_organizer
@@ -116,6 +176,9 @@ def create_poll():
     db.session.add(poll)
     for option in poll.options:
         db.session.add(option)
+    touch_polls(organizer)
+    db.session.flush()
+    tally.rebuild(poll.id)
     db.session.commit()
     data = {}
     data['poll'] = poll.to_dict()
@@ -134,9 +197,13 @@ def pollById(pollId):
         abort(404)
 
     if method == 'GET':
+        etag = make_etag('poll', poll.id, poll.version, poll.created_on, organizer.updated_on)
+        response = not_modified(etag)
+        if response:
+            return response
         data = {}
         data['poll'] = poll.to_dict()
-        return jsonify(status='success', data=data)
+        return tag(jsonify(status='success', data=data), etag)
 
     elif method == 'PUT':
         json = request.get_json()
@@ -147,8 +214,7 @@ def pollById(pollId):
             return jsonify(status='fail', data=error), 400
 
         # Don't allow editing of a poll that already has votes.
-        votes = poll.votes.all()
-        if votes:
+        if poll.votes.first():
             return jsonify(status='fail', message='The poll already has some votes and cannot be edited'), 403
 
         poll.question = new_poll.question
@@ -156,34 +222,34 @@ def pollById(pollId):
         poll.select_max = new_poll.select_max
         poll.start_time = new_poll.start_time
         poll.end_time = new_poll.end_time
-
-        # Delete all the old options.
-        for option in poll.options:
-            db.session.delete(option)
+        # Always bump the version, even if only the options changed.
+        poll.updated_on = db.func.now()
+        poll.version = Poll.version + 1
+        touch_polls(organizer)
+
+        # Delete all the old options and their tallies.
+        tally.clear(poll.id)
+        Option.query.filter_by(poll_id=poll.id).delete(synchronize_session=False)
+        db.session.expire(poll, ['options'])
         # Replace them with the new ones.
         for option in new_poll.options:
             # This needs to be done in a weird way to prevent new_poll from
             # being saved to the db because of relationship cascading.
             poll.options.append(Option(option=option.option))
+        db.session.flush()
+        tally.rebuild(poll.id)
 
         db.session.commit()
+        poll_cache.invalidate(poll.id)
         data = {}
         data['poll'] = poll.to_dict()
         return jsonify(status='success', data=data)
 
     elif method == 'DELETE':
-        # Delete all the option objects.
-        for option in poll.options:
-            db.session.delete(option)
-        # Delete all the code objects.
-        for code in poll.codes:
-            db.session.delete(code)
-        # Delete all the vote objects.
-        for vote in poll.votes:
-            db.session.delete(vote)
-        # Delete the poll itself.
-        db.session.delete(poll)
+        delete_poll(poll.id)
+        touch_polls(organizer)
         db.session.commit()
+        poll_cache.invalidate(pollId)
         return jsonify(status='success', data=None)
 
 
@@ -198,15 +264,72 @@ def get_votesByPollId(pollId):
     poll = Poll.query.filter_by(organizer=organizer, id=pollId).first()
     if poll == None:
         abort(404)
-    # TODO: Paginate.
-    votes = poll.votes.all()
+    page, error = parse_page(request.args)
+    if error:
+        return jsonify(status='fail', data=error), 400
+    after_id, limit = page
+
+    # Fetch one extra vote to know whether there is a next page.
+    votes = Vote.query_serializable().filter(Vote.poll_id == poll.id, Vote.id > after_id) \
+        .order_by(Vote.id).limit(limit + 1).all()
     data = {}
     data['votes'] = []
-    for vote in votes:
+    for vote in votes[:limit]:
         data['votes'].append(vote.to_dict())
+    data['next'] = None
+    if len(votes) > limit:
+        data['next'] = votes[limit - 1].id
+    return jsonify(status='success', data=data)
+
+
+# Returns the number of votes for each option of the poll.
+# With 'by=group' the counts are also broken down by member group.
+@app.route('/polls/<int:pollId>/results', methods=['GET'])
+@auth.requires_organizer
+def resultsByPollId(pollId):
+    organizer = auth.get_organizer()
+    if organizer == None:
+        abort(403)
+    poll = Poll.query.filter_by(organizer=organizer, id=pollId).first()
+    if poll == None:
+        abort(404)
+    by = request.args.get('by')
+    if by not in [None, 'group']:
+        data = {}
+        data['by'] = 'Results can only be broken down by \'group\''
+        return jsonify(status='fail', data=data), 400
+    data = {}
+    data['results'] = tally.results(poll, by_group=(by == 'group'))
     return jsonify(status='success', data=data)
 
 
+# Streams every vote of the poll without holding them in memory.
+# The 'format' parameter is either 'ndjson' (the default) or 'csv'.
+@app.route('/polls/<int:pollId>/votes/export', methods=['GET'])
+@auth.requires_organizer
+def export_votesByPollId(pollId):
+    organizer = auth.get_organizer()
+    if organizer == None:
+        abort(403)
+    poll = Poll.query.filter_by(organizer=organizer, id=pollId).first()
+    if poll == None:
+        abort(404)
+    format = request.args.get('format', 'ndjson')
+    if format not in export.EXPORT_FORMATS:
+        data = {}
+        data['format'] = 'The format must be one of: %s' % (', '.join(export.EXPORT_FORMATS))
+        return jsonify(status='fail', data=data), 400
+
+    if parse_flag(request.args.get('async')):
+        job = jobs.submit(organizer, 'export_votes', tasks.export_votes, poll.id, format)
+        return job_accepted(job)
+
+    mimetypes = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+    response = Response(stream_with_context(export.export_votes(poll.id, format)), mimetype=mimetypes[format])
+    response.headers['Content-Disposition'] = 'attachment; filename=poll-%d-votes.%s' % (poll.id, format)
+    return response
+
+
 @app.route('/polls/<int:pollId>/votes', methods=['POST'])
 # TODO: Test
 def post_votesByPollId(pollId):
@@ -223,10 +346,20 @@ def post_votesByPollId(pollId):
         abort(415)
     vote, error = parse_vote(json, poll)
     if error:
-        for key in error:
-            print '%s: %s' % (key, error[key])
+        if error.get('code') == CODE_USED_ERROR:
+            return jsonify(status='fail', data=error), 403
         return jsonify(status='fail', data=error), 400
     db.session.add(vote)
+    try:
+        # Flushing fails if the code has been used meanwhile.
+        db.session.flush()
+    except IntegrityError, e:
+        # Another request used the code between parsing and saving the vote.
+        db.session.rollback()
+        data = {}
+        data['code'] = CODE_USED_ERROR
+        return jsonify(status='fail', data=data), 403
+    tally.record_vote(vote)
     db.session.commit()
 
     data = {}
@@ -245,7 +378,7 @@ def voteById(pollId, voteId):
     poll = Poll.query.filter_by(organizer=organizer, id=pollId).first()
     if poll == None:
         abort(404)
-    vote = Vote.query.filter_by(poll=poll, id=voteId)
+    vote = Vote.query.filter_by(poll=poll, id=voteId).first()
     if vote == None:
         abort(404)
 
@@ -255,7 +388,11 @@ def voteById(pollId, voteId):
         return jsonify(status='success', data=data)
 
     elif method == 'DELETE':
+        poll_id = vote.poll_id
+        option_ids = [option.id for option in vote.options]
         db.session.delete(vote)
+        db.session.flush()
+        tally.void_vote(poll_id, option_ids)
         db.session.commit()
         return jsonify(status='success', data=None)
 
@@ -268,34 +405,67 @@ def members():
     if organizer == None:
         abort(403)
     if method == 'GET':
-        # TODO: Paginate.
-        members = Member.query.filter_by(organizer=organizer).all()
+        page, error = parse_page(request.args)
+        if error:
+            return jsonify(status='fail', data=error), 400
+        after_id, limit = page
+
+        # Replacing contacts always creates new ones, so the ids and counts of
+        # the members and contacts change whenever the listing does.
+        versions = db.session.query(db.func.count(db.distinct(Member.id)), db.func.max(Member.id), db.func.max(Member.updated_on),
+                db.func.count(Contact.id), db.func.max(Contact.id)) \
+            .outerjoin(Contact, Contact.member_id == Member.id) \
+            .filter(Member.organizer_id == organizer.id).one()
+        etag = make_etag('members', organizer.id, request.query_string, *versions)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        query = Member.query_serializable().filter(Member.organizer_id == organizer.id, Member.id > after_id)
+        group = request.args.get('group')
+        if group:
+            query = query.filter(Member.group == group)
+        name = request.args.get('name')
+        if name:
+            query = query.filter(Member.name.like(escape_like(name) + '%', escape='\\'))
+
+        # Fetch one extra member to know whether there is a next page.
+        members = query.order_by(Member.id).limit(limit + 1).all()
         data = {}
         data['members'] = []
-        for member in members:
+        for member in members[:limit]:
             data['members'].append(member.to_dict())
-        return jsonify(status='success', data=data)
+        data['next'] = None
+        if len(members) > limit:
+            data['next'] = members[limit - 1].id
+        return tag(jsonify(status='success', data=data), etag)
 
     elif method == 'POST':
         # Parse the members from an excel file if a file is specified.
         if 'excel_file' in request.files:
             file = request.files['excel_file']
-            update = False
-            if 'update' in request
             error = {}
             if not file or not allowed_file(file.filename):
                 error['excel_file'] = 'A .xls or .xlsx file is required'
                 return jsonify(status='fail', data=error), 400
-            members = xlprsr.parse_file(file)
-            try:
-                for member in members:
-                    member.organizer = organizer
-                    db.session.add(member)
-                db.session.commit()
-            except IntegrityError, e:
-                error['excel_file'] = 'One or more members already exist in the database'
-                return jsonify(status='fail', data=errar), 400
-                raise e
+            # In update mode the members are synced with the sheet instead of
+            # only adding new ones.
+            update = parse_flag(request.form.get('update'))
+            if parse_flag(request.args.get('async')):
+                job = jobs.submit(organizer, 'import_members', tasks.import_members, organizer.id, file.read(), update)
+                return job_accepted(job)
+            rows, error = xlprsr.parse_file(file)
+            if error:
+                return jsonify(status='fail', data=error), 400
+            if update:
+                report = memberimport.sync_members(organizer, rows)
+            else:
+                report = memberimport.import_members(organizer, rows)
+            data = {}
+            data['import'] = report
+            if report[memberimport.CREATED]:
+                return jsonify(status='success', data=data), 201
+            return jsonify(status='success', data=data)
         else:
             json = request.get_json()
             if not json:
@@ -326,9 +496,15 @@ def memberById(memberId):
         abort(404)
 
     if method == 'GET':
+        versions = db.session.query(db.func.count(Contact.id), db.func.max(Contact.id)) \
+            .filter(Contact.member_id == member.id).one()
+        etag = make_etag('member', member.id, member.updated_on, *versions)
+        response = not_modified(etag)
+        if response:
+            return response
         data = {}
         data['member'] = member.to_dict()
-        return jsonify(status='success', data=data)
+        return tag(jsonify(status='success', data=data), etag)
 
     elif method == 'PUT':
         json = request.get_json()
@@ -339,8 +515,8 @@ def memberById(memberId):
             return jsonify(status='fail', data=error)
 
         # Delete the old contact objects.
-        for contact in member.contacts:
-            db.session.delete(contact)
+        Contact.query.filter_by(member_id=member.id).delete(synchronize_session=False)
+        db.session.expire(member, ['contacts'])
 
         member.name = new_member.name
         member.group = new_member.group
@@ -356,9 +532,12 @@ def memberById(memberId):
 
 
     elif method == 'DELETE':
-        for contact in member.contacts:
-            db.session.delete(contact)
-        db.session.delete(member)
+        Contact.query.filter_by(member_id=member.id).delete(synchronize_session=False)
+        # Keep the member's codes and votes but detach them, like deleting the
+        # member through the relationships did.
+        for model in [Code, Vote]:
+            model.query.filter_by(member_id=member.id).update({'member_id': None}, synchronize_session=False)
+        Member.query.filter_by(id=member.id).delete(synchronize_session=False)
         db.session.commit()
         return jsonify(status='success', data=None)
 
@@ -389,24 +568,102 @@ def code(pollId):
         codes, error = parse_codes(json, poll)
         if error:
             return jsonify(status='fail', data=error), 400
-        
-        for code in codes:
-            length = 10
-            # Make sure the generated code is unique.
-            token = ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(length))
-            while models.Code.query.filter_by(code=token).first():
-                token = ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(length))
-            code.code = token
-            db.session.add(code)
-        db.session.commit()
-
+        if parse_flag(request.args.get('async')):
+            member_ids = [code.member_id for code in codes]
+            job = jobs.submit(organizer, 'create_codes', tasks.create_codes, poll.id, member_ids)
+            return job_accepted(job)
+
+        try:
+            codes = codegen.create_codes(codes)
+        except IntegrityError, e:
+            # Another request gave one of the members a code meanwhile.
+            db.session.rollback()
+            data = {}
+            data['member_ids'] = CODE_EXISTS_ERROR
+            return jsonify(status='fail', data=data), 400
+        # Committing expires the codes, so serialize them first to avoid a
+        # refresh query per code.
         data ={}
         data['codes'] = []
         for code in codes:
             data['codes'].append(code.to_dict())
+        db.session.commit()
         return jsonify(status='success', data=data), 201
 
 
+# Emails every member with a code for the poll their voting code.
+# Sending runs as a background job. Codes that have already been sent are
+# skipped unless 'resend' is true.
+@app.route('/polls/<int:pollId>/emails', methods=['POST'])
+@auth.requires_organizer
+def emailsByPollId(pollId):
+    organizer = auth.get_organizer()
+    if not organizer:
+        abort(403)
+    poll = Poll.query.filter_by(id=pollId, organizer=organizer).first()
+    if not poll:
+        abort(404)
+    json = request.get_json(silent=True) or {}
+    emails, error = parse_emails(json)
+    if error:
+        return jsonify(status='fail', data=error), 400
+    job = jobs.submit(organizer, 'send_codes', tasks.send_codes, poll.id, emails)
+    return job_accepted(job)
+
+# Reports the status, progress and result of a background job.
+@app.route('/jobs/<int:jobId>', methods=['GET'])
+@auth.requires_organizer
+def jobById(jobId):
+    organizer = auth.get_organizer()
+    if not organizer:
+        abort(403)
+    job = Job.query.filter_by(id=jobId, organizer_id=organizer.id).first()
+    if not job:
+        abort(404)
+    data = {}
+    data['job'] = job.to_dict()
+    return jsonify(status='success', data=data)
+
+# Downloads the file written by a finished export job.
+@app.route('/jobs/<int:jobId>/file', methods=['GET'])
+@auth.requires_organizer
+def jobFileById(jobId):
+    organizer = auth.get_organizer()
+    if not organizer:
+        abort(403)
+    job = Job.query.filter_by(id=jobId, organizer_id=organizer.id).first()
+    if not job or job.status != jobs.DONE:
+        abort(404)
+    result = job.to_dict()['result']
+    if not result or 'file' not in result:
+        abort(404)
+    return send_from_directory(app.config['JOB_DIR'], result['file'], as_attachment=True)
+
+# Returns a 202 response pointing to the given job.
+def job_accepted(job):
+    data = {}
+    data['job'] = job.to_dict()
+    response = jsonify(status='success', data=data)
+    response.status_code = 202
+    response.headers['Location'] = url_for('jobById', jobId=job.id)
+    return response
+
+# Bumps the version of the organizer's poll list in the same transaction as the
+# change to the list.
+def touch_polls(organizer):
+    organizer.polls_version = Organizer.polls_version + 1
+
+# Deletes a poll and everything that belongs to it with one set-based
+# statement per table, without loading any rows. The caller is responsible for
+# committing.
+def delete_poll(poll_id):
+    votes = db.select([Vote.id]).where(Vote.poll_id == poll_id)
+    db.session.execute(vote_option.delete().where(vote_option.c.vote_id.in_(votes)))
+    tally.clear(poll_id)
+    for model in [Vote, Code, Option]:
+        model.query.filter_by(poll_id=poll_id).delete(synchronize_session=False)
+    Poll.query.filter_by(id=poll_id).delete(synchronize_session=False)
+
 def allowed_file(filename):
     allowed_extensions = ['xls', 'xlsx']
     return '.' in filename and filename.rsplit('.', 1)[1] in allowed_extensions
@@ -1,30 +1,156 @@
 from functools import wraps
-from flask import request, jsonify, abort
+from flask import request, jsonify, abort, g
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+from collections import OrderedDict
+import hashlib
+import hmac
+import os
+import threading
+import time
 import models
 
+# How long a verified username/password pair is trusted without rehashing.
+CREDENTIAL_CACHE_TTL = 300
+# The maximum number of verified credentials remembered by the process.
+CREDENTIAL_CACHE_SIZE = 1024
+
+# A bounded, TTL-evicting cache of recently verified credentials.
+# Passwords are never stored; only a keyed digest of the username and password
+# is kept, using a key that only lives in this process.
+class CredentialCache(object):
+    def __init__(self, max_size=CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password):
+        message = _to_bytes(username) + ':' + _to_bytes(password)
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    # Returns the password hash the credentials were verified against if they
+    # were verified recently, None otherwise.
+    def get(self, username, password):
+        digest = self._digest(username, password)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            entry_digest, password_hash, expires = entry
+            if expires < now:
+                del self._entries[username]
+                return None
+        if not hmac.compare_digest(entry_digest, digest):
+            return None
+        return password_hash
+
+    def add(self, username, password, password_hash):
+        digest = self._digest(username, password)
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(username, None)
+            self._entries[username] = (digest, password_hash, expires)
+            # Evict the oldest entries when the cache is full.
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # Forget the credentials of the given username, or of everyone if no
+    # username is given.
+    def invalidate(self, username=None):
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+credential_cache = CredentialCache()
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+# Drop cached credentials whenever a password or role changes.
+@event.listens_for(models.User.password_hash, 'set')
+@event.listens_for(models.User.is_admin, 'set')
+def _invalidate_user(target, value, oldvalue, initiator):
+    if target.username is not None:
+        credential_cache.invalidate(target.username)
+
+@event.listens_for(models.User.username, 'set')
+def _invalidate_username(target, value, oldvalue, initiator):
+    if isinstance(oldvalue, basestring):
+        credential_cache.invalidate(oldvalue)
+
+@event.listens_for(models.Organizer.user, 'set')
+def _invalidate_organizer(target, value, oldvalue, initiator):
+    for user in (value, oldvalue):
+        if isinstance(user, models.User) and user.username is not None:
+            credential_cache.invalidate(user.username)
+
+# The authenticated user of the current request.
+# Resolved at most once per request and shared by the decorators and views.
+class Principal(object):
+    def __init__(self, user, via_token=False):
+        self.user = user
+        self.via_token = via_token
+        self.organizer = user.organizer
+        self.is_admin = bool(user.is_admin)
+        self.is_organizer = self.organizer is not None
+
 # Check if the username exists and that the password is valid.
+# Returns the user on success, None otherwise.
 def check_auth(username, password):
-    user = models.User.query.filter_by(username=username).first()
+    user = models.User.query.options(joinedload('organizer')).filter_by(username=username).first()
     if user == None:
-        return False
-    return user.verify_password(password)
+        return None
+    # Comparing against the stored hash also catches password changes made by
+    # other processes.
+    if credential_cache.get(username, password) == user.password_hash:
+        return user
+    if not user.verify_password(password):
+        return None
+    credential_cache.add(username, password, user.password_hash)
+    return user
 
-# Check if the given username belongs to an admin.
-def is_admin(username):
-    user = models.User.query.filter_by(username=username).first()
-    if user == None:
-        return False
-    return user.is_admin
+# Returns the token from an 'Authorization: Bearer <token>' header, if any.
+def get_bearer_token():
+    header = request.headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    return token.strip()
 
-# Check if the given username belongs to an organizer.
-def is_organizer(username):
-    user = models.User.query.filter_by(username=username).first()
-    if user == None:
-        return False
-    organizer = models.Organizer.query.filter_by(user=user).first()
-    if organizer == None:
-        return False
-    return True
+# Returns the principal of the current request or None if the request is not
+# authenticated. Bearer tokens only cost a signature check and a primary key
+# lookup; Basic credentials go through check_auth.
+def get_principal():
+    if not hasattr(g, 'principal'):
+        g.principal = None
+        token = get_bearer_token()
+        auth = request.authorization
+        if token:
+            user = models.User.verify_auth_token(token)
+            if user != None:
+                g.principal = Principal(user, via_token=True)
+        elif auth:
+            user = check_auth(auth.username, auth.password)
+            if user != None:
+                g.principal = Principal(user)
+    return g.principal
+
+# Check if the current request was made by an admin.
+def is_admin():
+    principal = get_principal()
+    return principal != None and principal.is_admin
+
+# Check if the current request was made by an organizer.
+def is_organizer():
+    principal = get_principal()
+    return principal != None and principal.is_organizer
 
 def authenticate_response():
     abort(401)
@@ -37,13 +163,23 @@ def forbidden_response():
     #response = jsonify(status='fail', data=None)
     #response.status_code = 403
     #return response
- 
+
 # Make sure the user is authenticated.
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
+        if not get_principal():
+            return authenticate_response()
+        return f(*args, **kwargs)
+    return decorated
+
+# Make sure the user is authenticated with a username and password rather than
+# a token.
+def requires_password(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        principal = get_principal()
+        if not principal or principal.via_token:
             return authenticate_response()
         return f(*args, **kwargs)
     return decorated
@@ -52,10 +188,9 @@ def requires_auth(f):
 def requires_admin(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
+        if not get_principal():
             return authenticate_response()
-        elif not is_admin(auth.username):
+        elif not is_admin():
             return forbidden_response()
         return f(*args, **kwargs)
     return decorated
@@ -64,24 +199,21 @@ def requires_admin(f):
 def requires_organizer(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
+        if not get_principal():
             return authenticate_response()
-        elif not is_organizer(auth.username):
+        elif not is_organizer():
             return forbidden_response()
         return f(*args, **kwargs)
     return decorated
 
 def get_user():
-    auth = request.authorization
-    if not auth or not check_auth(auth.username, auth.password):
+    principal = get_principal()
+    if principal == None:
         return None
-    user = models.User.query.filter_by(username=auth.username).first()
-    return user
+    return principal.user
 
 def get_organizer():
-    user = get_user()
-    if user == None:
+    principal = get_principal()
+    if principal == None:
         return None
-    organizer = user.organizer
-    return organizer
+    return principal.organizer
@@ -0,0 +1,244 @@
+#!flask/bin/python
+# Load test modelled on an election day.
+#
+# Seeds a poll with thousands of members and voting codes, casts part of the
+# ballots up front and then has voters and organizers use the API at the same
+# time through the Flask test client:
+#
+#   voters:     GET /polls?code=<code>, then POST /polls/<id>/votes
+#   organizers: GET /polls/<id>/results, the first page of GET /polls/<id>/votes
+#               and of GET /members, and GET /polls/<id>
+#
+# Prints the throughput, the p50/p99 latency and the queries per request of
+# every endpoint. With --save the numbers are stored as the baseline; with
+# --check the run fails if an endpoint got slower or needs more queries than
+# in the baseline.
+#
+#   python benchmark.py --members 5000 --voters 2000 --save
+#   python benchmark.py --members 5000 --voters 2000 --check
+import os
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+# Never touch the real database.
+os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'benchmark.db')
+
+from app import app, db
+from models import *
+from parser import parse_poll, parse_member
+from fixtures import generate_poll, generate_members
+from datetime import datetime, timedelta
+from util import chunked
+from Queue import Queue, Empty
+import argparse
+import base64
+import codegen
+import json
+import random
+import sys
+import tally
+import threading
+import time
+
+ORGANIZER = 'benchmark'
+PASSWORD = 'password'
+
+# Members, codes and ballots are saved this many at a time.
+SEED_BATCH_SIZE = 500
+
+BASELINE_FILE = os.path.join(basedir, 'benchmark_baseline.json')
+
+# Creates an organizer with a poll that is open for voting and the given
+# number of members, each with a voting code. The first ballots of them have
+# already been cast.
+# Returns the id of the poll, the ids of its options and the unused codes.
+def seed(members, ballots):
+    db.drop_all()
+    db.create_all()
+
+    user = User(ORGANIZER, PASSWORD)
+    organizer = Organizer('Benchmark')
+    organizer.user = user
+    db.session.add(user)
+    db.session.add(organizer)
+
+    poll, error = parse_poll(generate_poll())
+    poll.start_time = datetime.now() - timedelta(hours=1)
+    poll.organizer = organizer
+    db.session.add(poll)
+    db.session.flush()
+    options = dict((option.id, option) for option in poll.options)
+    option_ids = sorted(options)
+
+    member_ids = []
+    for batch in chunked(generate_members(members), SEED_BATCH_SIZE):
+        saved = []
+        for memberdict in batch:
+            member, error = parse_member(memberdict)
+            member.organizer = organizer
+            db.session.add(member)
+            saved.append(member)
+        db.session.flush()
+        member_ids.extend(member.id for member in saved)
+
+    codes = codegen.create_codes([Code(poll_id=poll.id, member_id=member_id) for member_id in member_ids])
+
+    for batch in chunked(codes[:ballots], SEED_BATCH_SIZE):
+        for code in batch:
+            option = options[random.choice(option_ids)]
+            db.session.add(Vote(time=datetime.now(), code_id=code.id, member_id=code.member_id, poll_id=poll.id, options=[option]))
+        db.session.flush()
+    tally.rebuild(poll.id)
+
+    db.session.commit()
+    return poll.id, option_ids, [code.code for code in codes[ballots:]]
+
+# Records the latency, status and query count of every request.
+class Recorder(object):
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    # Sends a request with the test client and records it under the given name.
+    def request(self, name, client, method, url, **kwargs):
+        start = time.time()
+        res = client.open(url, method=method, **kwargs)
+        elapsed = time.time() - start
+        queries = int(res.headers.get('X-Query-Count', 0))
+        with self._lock:
+            self.samples.setdefault(name, []).append((elapsed, res.status_code, queries))
+        return res
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+# Casts a ballot for every code in the queue.
+def vote(recorder, codes, poll_id, option_ids):
+    client = app.test_client()
+    headers = {'Content-Type': 'application/json'}
+    while True:
+        try:
+            code = codes.get_nowait()
+        except Empty:
+            return
+        recorder.request('GET /polls?code=', client, 'GET', '/polls?code=%s' % (code))
+        data = {'code': code, 'options': [random.choice(option_ids)]}
+        recorder.request('POST /polls/<id>/votes', client, 'POST', '/polls/%d/votes' % (poll_id), data=json.dumps(data), headers=headers)
+
+# Follows the organizer dashboard until the voters are done.
+def organize(recorder, done, poll_id):
+    client = app.test_client()
+    headers = {'Authorization': 'Basic ' + base64.b64encode(ORGANIZER + ':' + PASSWORD)}
+    res = client.get('/token', headers=headers)
+    token = json.loads(res.get_data())['data']['token']
+    headers = {'Authorization': 'Bearer ' + token}
+    while not done.is_set():
+        recorder.request('GET /polls/<id>/results', client, 'GET', '/polls/%d/results' % (poll_id), headers=headers)
+        recorder.request('GET /polls/<id>/votes', client, 'GET', '/polls/%d/votes?limit=100' % (poll_id), headers=headers)
+        recorder.request('GET /members', client, 'GET', '/members?limit=100', headers=headers)
+        recorder.request('GET /polls/<id>', client, 'GET', '/polls/%d' % (poll_id), headers=headers)
+
+# Runs the voters and organizers at the same time.
+# Returns the recorder and the duration of the run in seconds.
+def run(poll_id, option_ids, codes, concurrency, organizers):
+    recorder = Recorder()
+    queue = Queue()
+    for code in codes:
+        queue.put(code)
+    done = threading.Event()
+
+    voters = [threading.Thread(target=vote, args=(recorder, queue, poll_id, option_ids)) for _ in xrange(0, concurrency)]
+    dashboards = [threading.Thread(target=organize, args=(recorder, done, poll_id)) for _ in xrange(0, organizers)]
+    start = time.time()
+    for thread in voters + dashboards:
+        thread.start()
+    for thread in voters:
+        thread.join()
+    done.set()
+    for thread in dashboards:
+        thread.join()
+    return recorder, time.time() - start
+
+# Returns a dictionary of endpoint name to its statistics.
+def summarize(recorder, duration):
+    stats = {}
+    for name, samples in recorder.samples.iteritems():
+        latencies = [elapsed * 1000 for elapsed, _, _ in samples]
+        stats[name] = {
+            'requests': len(samples),
+            'errors': sum(1 for _, status, _ in samples if status >= 500),
+            'throughput': len(samples) / duration,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'queries': sum(queries for _, _, queries in samples) / float(len(samples)),
+        }
+    return stats
+
+def report(stats, duration):
+    total = sum(stat['requests'] for stat in stats.itervalues())
+    print '%d requests in %.1f s, %.1f requests/s' % (total, duration, total / duration)
+    print '%-28s %8s %7s %8s %9s %9s %8s' % ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'queries')
+    for name in sorted(stats):
+        stat = stats[name]
+        print '%-28s %8d %7d %8.1f %9.2f %9.2f %8.2f' % (name, stat['requests'], stat['errors'], stat['throughput'], stat['p50'], stat['p99'], stat['queries'])
+
+# Returns a list of regressions compared to the baseline.
+# Latencies may be tolerance times slower than the baseline since they vary
+# between runs; query counts don't, so any increase is a regression.
+def compare(stats, baseline, tolerance):
+    regressions = []
+    for name, base in sorted(baseline.iteritems()):
+        stat = stats.get(name)
+        if stat is None:
+            continue
+        for key in ['p50', 'p99']:
+            if stat[key] > base[key] * (1 + tolerance):
+                regressions.append('%s: %s went from %.2f ms to %.2f ms' % (name, key, base[key], stat[key]))
+        if stat['queries'] > base['queries'] + 0.01:
+            regressions.append('%s: queries went from %.2f to %.2f' % (name, base['queries'], stat['queries']))
+        if stat['errors'] > base['errors']:
+            regressions.append('%s: errors went from %d to %d' % (name, base['errors'], stat['errors']))
+    return regressions
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Load test the eVote API.')
+    arg_parser.add_argument('--members', type=int, default=5000, help='members with a voting code')
+    arg_parser.add_argument('--voters', type=int, default=2000, help='members voting during the run')
+    arg_parser.add_argument('--concurrency', type=int, default=8, help='voters voting at the same time')
+    arg_parser.add_argument('--organizers', type=int, default=2, help='organizers following the results')
+    arg_parser.add_argument('--baseline', default=BASELINE_FILE, help='the baseline file')
+    arg_parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    arg_parser.add_argument('--check', action='store_true', help='fail if the results are worse than the baseline')
+    arg_parser.add_argument('--tolerance', type=float, default=0.25, help='allowed latency increase, 0.25 is 25%%')
+    args = arg_parser.parse_args()
+    if args.voters > args.members:
+        arg_parser.error('there cannot be more voters than members')
+
+    app.config['QUERY_COUNT_HEADER'] = True
+
+    print 'Seeding %d members, %d ballots already cast' % (args.members, args.members - args.voters)
+    poll_id, option_ids, codes = seed(args.members, args.members - args.voters)
+    db.session.remove()
+
+    print 'Running %d voters and %d organizers' % (args.concurrency, args.organizers)
+    recorder, duration = run(poll_id, option_ids, codes, args.concurrency, args.organizers)
+    stats = summarize(recorder, duration)
+    report(stats, duration)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        print 'Baseline saved to %s' % (args.baseline)
+
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(stats, baseline, args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION %s' % (regression)
+        if regressions:
+            sys.exit(1)
+        print 'No regressions against %s' % (args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+import threading
+
+# The maximum number of serialized polls kept by the process.
+POLL_CACHE_SIZE = 1024
+
+# An in-process cache of serialized poll payloads keyed by poll id.
+# Each entry remembers the version of the poll it was built from, so
+# a poll changed by another process is never served from a stale entry.
+# Compressed copies of the payload are kept alongside it.
+class PollCache(object):
+    def __init__(self, max_size=POLL_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns the cached payload for the poll or None if there is no entry for
+    # this version of the poll.
+    def get(self, poll_id, version):
+        with self._lock:
+            entry = self._entries.get(poll_id)
+            if entry is None:
+                return None
+            entry_version, payload, encoded = entry
+            if entry_version != version:
+                del self._entries[poll_id]
+                return None
+            # Keep recently used polls at the end.
+            del self._entries[poll_id]
+            self._entries[poll_id] = entry
+            return payload
+
+    def set(self, poll_id, version, payload):
+        with self._lock:
+            self._entries.pop(poll_id, None)
+            self._entries[poll_id] = (version, payload, {})
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # Returns the payload compressed with the given content encoding or None if
+    # it hasn't been compressed yet.
+    def get_encoded(self, poll_id, version, content_encoding):
+        with self._lock:
+            entry = self._entries.get(poll_id)
+            if entry is None or entry[0] != version:
+                return None
+            return entry[2].get(content_encoding)
+
+    # Remembers the compressed payload if the entry is still for this version.
+    def set_encoded(self, poll_id, version, content_encoding, body):
+        with self._lock:
+            entry = self._entries.get(poll_id)
+            if entry is not None and entry[0] == version:
+                entry[2][content_encoding] = body
+
+    def invalidate(self, poll_id=None):
+        with self._lock:
+            if poll_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(poll_id, None)
+
+poll_cache = PollCache()
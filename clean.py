@@ -1,37 +1,5 @@
 from app import *
-
-def generate_poll():
-    now = datetime.now()
-    # Add a second to be safe.
-    now = now + timedelta(seconds=1)
-    tomorrow = now + timedelta(days=1)
-
-    poll = {}
-    poll['question'] = random_string(20) + '?'
-    poll['start_time'] = now.isoformat()
-    poll['end_time'] = tomorrow.isoformat()
-    poll['select_min'] = 1
-    poll['select_max'] = 1
-    poll['options'] = ['Yes', 'No', 'Abstain']
-    return poll
-
-def generate_member():
-    member = {}
-    member['name'] = random_string(10)
-    member['group'] = random_string(10)
-    numcontacts = random.randint(1, 5)
-    member['contacts'] = []
-    for i in xrange(0, numcontacts):
-        contact = {}
-        contact['name'] = random_string(10)
-        contact['email'] = random_string(7) + '@example.com'
-        member['contacts'].append(contact)
-    return member
-
-
-def random_string(length):
-    return ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(length))
-
+from fixtures import *
 
 print 'Dropping tables'
 db.drop_all()
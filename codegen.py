@@ -0,0 +1,62 @@
+import os
+import string
+import models
+from app import db
+from util import chunked
+
+CODE_ALPHABET = string.ascii_lowercase + string.digits
+CODE_LENGTH = 10
+# Codes are checked and inserted this many at a time. SQLite allows at most
+# 999 variables in a single statement.
+BATCH_SIZE = 500
+
+# Returns a list of count random tokens.
+# All randomness comes from os.urandom, read in bulk. Bytes that would bias the
+# choice of characters are discarded.
+def random_tokens(count, length=CODE_LENGTH):
+    alphabet_size = len(CODE_ALPHABET)
+    limit = 256 - (256 % alphabet_size)
+    needed = count * length
+    chars = []
+    while len(chars) < needed:
+        # Read a little extra to make up for discarded bytes.
+        for byte in os.urandom(needed - len(chars) + 16):
+            value = ord(byte)
+            if value < limit:
+                chars.append(CODE_ALPHABET[value % alphabet_size])
+    chars = chars[:needed]
+    return [''.join(chars[i:i + length]) for i in xrange(0, needed, length)]
+
+# Returns a set of count tokens that are unique among themselves and do not
+# exist in the database. Costs one query per round; a second round is only
+# needed in the unlikely case of a collision.
+def unique_tokens(count):
+    tokens = set()
+    while len(tokens) < count:
+        candidates = set(random_tokens(count - len(tokens))) - tokens
+        existing = db.session.query(models.Code.code).filter(models.Code.code.in_(list(candidates))).all()
+        tokens.update(candidates - set(code for (code,) in existing))
+    return tokens
+
+# Assigns a unique token to each of the given unsaved codes and saves them with
+# bulk inserts. The caller is responsible for committing.
+# Returns the saved codes in the same order.
+# If given, progress is called with the number of saved codes and the total
+# after every batch.
+def create_codes(codes, progress=None):
+    saved = []
+    for batch in chunked(codes, BATCH_SIZE):
+        tokens = list(unique_tokens(len(batch)))
+        rows = []
+        for code, token in zip(batch, tokens):
+            code.code = token
+            rows.append({'code': token, 'poll_id': code.poll_id, 'member_id': code.member_id})
+        db.session.execute(models.Code.__table__.insert(), rows)
+        # Read the codes back to get their ids.
+        by_token = {}
+        for code in models.Code.query.filter(models.Code.code.in_(tokens)):
+            by_token[code.code] = code
+        saved.extend(by_token[code.code] for code in batch)
+        if progress:
+            progress(len(saved), len(codes))
+    return saved
@@ -0,0 +1,104 @@
+from flask import request, current_app
+from collections import OrderedDict
+from conditional import encoded_etag
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Only text is worth compressing.
+COMPRESSIBLE_MIMETYPES = set(['application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html'])
+
+def _gzip_compressor():
+    compressor = zlib.compressobj(current_app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+def _brotli_compressor():
+    compressor = brotli.Compressor(quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+    return compressor.process, compressor.finish
+
+# The supported content encodings, preferred first. Each entry returns the
+# compress and finish functions of a new compressor.
+ENCODERS = OrderedDict()
+if brotli is not None:
+    ENCODERS['br'] = _brotli_compressor
+ENCODERS['gzip'] = _gzip_compressor
+
+# Returns the content encoding the client accepts that we prefer, or None.
+def negotiate():
+    best = None
+    best_quality = 0
+    for name in ENCODERS:
+        quality = request.accept_encodings[name]
+        if quality > best_quality:
+            best = name
+            best_quality = quality
+    return best
+
+def _to_bytes(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+# Returns data compressed with the given content encoding.
+def compress(data, content_encoding):
+    process, finish = ENCODERS[content_encoding]()
+    return process(_to_bytes(data)) + finish()
+
+# Compresses the chunks of a streamed response as they are produced.
+# The compressor is created up front since the chunks may be produced after
+# the request context is gone.
+def compress_stream(chunks, content_encoding):
+    process, finish = ENCODERS[content_encoding]()
+    def generate():
+        try:
+            for chunk in chunks:
+                data = process(_to_bytes(chunk))
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+    return generate()
+
+# Marks the response body as compressed with the given content encoding.
+# Each encoding of a resource is a different representation, so it gets its
+# own ETag.
+def set_content_encoding(response, content_encoding):
+    response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, content_encoding), weak)
+    return response
+
+def init_app(app):
+    @app.after_request
+    def compress_response(response):
+        if response.status_code == 304:
+            response.vary.add('Accept-Encoding')
+            return response
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+        content_encoding = negotiate()
+        if content_encoding is None:
+            return response
+
+        if response.is_streamed:
+            # The size of a stream isn't known up front, so always compress.
+            response.response = compress_stream(response.response, content_encoding)
+            response.direct_passthrough = False
+            response.headers.pop('Content-Length', None)
+            response.headers.pop('Accept-Ranges', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress(data, content_encoding))
+        return set_content_encoding(response, content_encoding)
@@ -0,0 +1,31 @@
+from flask import request, current_app
+import hashlib
+
+# Returns an ETag for a version of a resource described by the given parts.
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(unicode(part) for part in parts).encode('utf-8')).hexdigest()
+
+# Compressed responses get the ETag of the uncompressed one with the content
+# encoding appended. See compression.py.
+CONTENT_ENCODINGS = ['br', 'gzip']
+
+def encoded_etag(etag, content_encoding):
+    return '%s-%s' % (etag, content_encoding)
+
+# Returns a 304 Not Modified response if the client already has the version of
+# the resource with the given ETag, in any encoding, None otherwise.
+def not_modified(etag):
+    candidates = [etag] + [encoded_etag(etag, name) for name in CONTENT_ENCODINGS]
+    for candidate in candidates:
+        if request.if_none_match.contains(candidate):
+            response = current_app.response_class(status=304)
+            tag(response, candidate)
+            return response
+    return None
+
+# Sets the ETag of a response. Clients have to revalidate before reusing it.
+def tag(response, etag):
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -2,5 +2,63 @@ import os
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'evote.db')
+# A server database such as PostgreSQL can be used by setting DATABASE_URL.
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'evote.db')
+
+# Connection pool settings for server databases. Each worker process has its
+# own pool, so the database must accept (pool size + overflow) * workers
+# connections. Connections are recycled before typical server timeouts.
+SQLALCHEMY_POOL_SIZE = int(os.environ.get('EVOTE_POOL_SIZE', 10))
+SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('EVOTE_MAX_OVERFLOW', 20))
+SQLALCHEMY_POOL_TIMEOUT = 10
+SQLALCHEMY_POOL_RECYCLE = 1800
+
+# SQLite settings. In WAL mode readers don't block the writer, and NORMAL
+# synchronous is safe with WAL. Writers wait up to the busy timeout, in
+# milliseconds, for a lock instead of failing.
+SQLITE_WAL = True
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_BUSY_TIMEOUT = 5000
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
+
+# Used to sign authentication tokens. Set EVOTE_SECRET_KEY when running more
+# than one process, otherwise tokens are only valid in the process that issued
+# them and only until it restarts.
+SECRET_KEY = os.environ.get('EVOTE_SECRET_KEY') or os.urandom(32)
+# Lifetime of authentication tokens in seconds.
+TOKEN_EXPIRATION = 600
+
+# Report the number of database queries of each request in an X-Query-Count
+# response header.
+QUERY_COUNT_HEADER = False
+
+# The library used to encode JSON responses: 'orjson', 'ujson' or 'json'.
+# By default the fastest one installed is used.
+JSON_BACKEND = os.environ.get('EVOTE_JSON_BACKEND')
+
+# Responses of at least COMPRESS_MIN_SIZE bytes are compressed with gzip, or
+# with brotli if it is installed, when the client accepts it. Streamed
+# responses are always compressed.
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5
+
+# The number of threads running background jobs.
+JOB_WORKERS = 2
+# Where background jobs write files, such as vote exports.
+JOB_DIR = os.path.join(basedir, 'jobs')
+
+# The SMTP server used to email voting codes.
+MAIL_SERVER = os.environ.get('EVOTE_MAIL_SERVER', 'localhost')
+MAIL_PORT = int(os.environ.get('EVOTE_MAIL_PORT', 25))
+MAIL_USE_TLS = False
+MAIL_USERNAME = os.environ.get('EVOTE_MAIL_USERNAME')
+MAIL_PASSWORD = os.environ.get('EVOTE_MAIL_PASSWORD')
+MAIL_SENDER = os.environ.get('EVOTE_MAIL_SENDER', 'evote@localhost')
+MAIL_TIMEOUT = 30
+# The number of SMTP connections used at the same time.
+MAIL_POOL_SIZE = 4
+# Sending a message is retried this many times, waiting MAIL_BACKOFF seconds
+# before the first retry and twice as long before every following one.
+MAIL_RETRIES = 3
+MAIL_BACKOFF = 1.0
@@ -0,0 +1,33 @@
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
+
+# SQLAlchemy configured for the database in use.
+# SQLite databases run in WAL mode so readers don't block the writer, and wait
+# for locks instead of failing with 'database is locked'. Server databases get
+# a sized connection pool that checks connections before using them.
+class Database(SQLAlchemy):
+    def init_app(self, app):
+        super(Database, self).init_app(app)
+        config = app.config
+
+        @event.listens_for(Engine, 'connect')
+        def configure_sqlite(dbapi_connection, connection_record):
+            if not isinstance(dbapi_connection, sqlite3.Connection):
+                return
+            cursor = dbapi_connection.cursor()
+            if config['SQLITE_WAL']:
+                cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=%s' % (config['SQLITE_SYNCHRONOUS']))
+            cursor.execute('PRAGMA busy_timeout=%d' % (config['SQLITE_BUSY_TIMEOUT']))
+            cursor.close()
+
+    def apply_driver_hacks(self, app, info, options):
+        super(Database, self).apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('sqlite'):
+            # SQLite file databases don't use a sized pool.
+            for key in ['pool_size', 'pool_timeout', 'pool_recycle', 'max_overflow']:
+                options.pop(key, None)
+        else:
+            options.setdefault('pool_pre_ping', True)
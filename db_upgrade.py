@@ -1,7 +1,11 @@
 #!flask/bin/python
 from migrate.versioning import api
+from app import db
+from indexes import ensure_indexes
 from config import SQLALCHEMY_DATABASE_URI
 from config import SQLALCHEMY_MIGRATE_REPO
 api.upgrade(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
+for name in ensure_indexes(db.engine):
+    print('Created index ' + name)
 v = api.db_version(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
 print('Current database version: ' + str(v))
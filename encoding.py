@@ -0,0 +1,83 @@
+from flask import current_app
+from collections import OrderedDict
+from datetime import date, datetime
+import json
+
+# Encodes the values the JSON backends don't know about.
+# Dates and times are written in ISO 8601 format.
+def _default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+def _stdlib_backend():
+    def dumps(obj):
+        return json.dumps(obj, default=_default, separators=(',', ':'))
+    return dumps
+
+def _orjson_backend():
+    import orjson
+    # Write keys that aren't strings, such as ids and None, the way the
+    # standard library does.
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return dumps
+
+def _ujson_backend():
+    import ujson
+    def dumps(obj):
+        return ujson.dumps(obj, default=_default)
+    # Older versions of ujson ignore the default function and write dates as
+    # timestamps, so only use it if it gives the same result as the others.
+    probe = datetime(2000, 1, 1)
+    if dumps(probe) != '"%s"' % (probe.isoformat()):
+        raise ImportError('ujson does not support default')
+    # Keys that aren't strings must be written like the standard library does.
+    for key, expected in [(None, '{"null":1}'), (1, '{"1":1}')]:
+        try:
+            if dumps({key: 1}) != expected:
+                raise ImportError('ujson writes %r keys differently' % (key,))
+        except TypeError:
+            raise ImportError('ujson does not support %r keys' % (key,))
+    return dumps
+
+# The available JSON backends, fastest first. Each entry returns a dumps
+# function or raises ImportError if the backend is not installed.
+BACKENDS = OrderedDict([
+    ('orjson', _orjson_backend),
+    ('ujson', _ujson_backend),
+    ('json', _stdlib_backend),
+])
+
+backend = None
+_dumps = None
+
+# Switches to the given backend, or to the fastest installed one if no name is
+# given. Raises ImportError if the backend is not installed.
+def use_backend(name=None):
+    global backend, _dumps
+    if name is not None:
+        _dumps = BACKENDS[name]()
+        backend = name
+        return
+    for name, factory in BACKENDS.iteritems():
+        try:
+            _dumps = factory()
+        except Exception:
+            continue
+        backend = name
+        return
+
+use_backend()
+
+# Returns obj as a compact JSON document.
+def dumps(obj):
+    return _dumps(obj)
+
+# A drop-in replacement of flask.jsonify that uses the selected backend.
+def jsonify(*args, **kwargs):
+    return current_app.response_class(dumps(dict(*args, **kwargs)), mimetype='application/json')
+
+def init_app(app):
+    if app.config.get('JSON_BACKEND'):
+        use_backend(app.config['JSON_BACKEND'])
@@ -0,0 +1,86 @@
+from itertools import groupby
+from StringIO import StringIO
+import csv
+import encoding
+import models
+from app import db
+
+# The number of rows fetched from the database at a time.
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = ['ndjson', 'csv']
+
+CSV_COLUMNS = ['id', 'poll_id', 'member_id', 'code_id', 'code', 'option_ids', 'options']
+
+# Yields every vote of the poll as a dictionary with its id, poll_id,
+# member_id, code as {'id', 'code'} or None and options as a list of
+# {'id', 'option'}. This is Vote.to_dict() without the email status of the code.
+# Votes are read from a single streamed query, one row per selected option, so
+# memory use doesn't depend on the number of votes.
+def iter_votes(poll_id):
+    Vote = models.Vote
+    Code = models.Code
+    Option = models.Option
+    vote_option = models.vote_option
+    rows = db.session.query(Vote.id, Vote.poll_id, Vote.member_id, Code.id, Code.code, Option.id, Option.option) \
+        .outerjoin(Code, Vote.code_id == Code.id) \
+        .outerjoin(vote_option, vote_option.c.vote_id == Vote.id) \
+        .outerjoin(Option, vote_option.c.option_id == Option.id) \
+        .filter(Vote.poll_id == poll_id) \
+        .order_by(Vote.id, Option.id) \
+        .yield_per(EXPORT_BATCH_SIZE)
+    for vote_id, vote_rows in groupby(rows, lambda row: row[0]):
+        data = None
+        for _, poll_id, member_id, code_id, code, option_id, option in vote_rows:
+            if data is None:
+                data = {}
+                data['id'] = vote_id
+                data['code'] = None
+                if code_id is not None:
+                    data['code'] = {'id': code_id, 'code': code}
+                data['poll_id'] = poll_id
+                data['member_id'] = member_id
+                data['options'] = []
+            if option_id is not None:
+                data['options'].append({'id': option_id, 'option': option})
+        yield data
+
+# Yields the votes as newline delimited JSON.
+def ndjson_lines(votes):
+    for vote in votes:
+        yield encoding.dumps(vote) + '\n'
+
+# Yields the votes as CSV lines, starting with a header.
+# The ids and names of the selected options are separated by semicolons.
+def csv_lines(votes):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_COLUMNS)
+    for vote in votes:
+        code = vote['code'] or {}
+        writer.writerow([
+            vote['id'],
+            vote['poll_id'],
+            vote['member_id'],
+            code.get('id'),
+            _encode(code.get('code')),
+            ';'.join(str(option['id']) for option in vote['options']),
+            ';'.join(_encode(option['option']) for option in vote['options']),
+        ])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+# Yields the votes of the poll in the given format.
+def export_votes(poll_id, format):
+    votes = iter_votes(poll_id)
+    if format == 'csv':
+        return csv_lines(votes)
+    return ndjson_lines(votes)
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+import random
+import string
+
+# Returns a random poll as accepted by POST /polls. The poll opens a second
+# from now and closes a day later.
+def generate_poll():
+    now = datetime.now()
+    # Add a second to be safe.
+    now = now + timedelta(seconds=1)
+    tomorrow = now + timedelta(days=1)
+
+    poll = {}
+    poll['question'] = random_string(20) + '?'
+    poll['start_time'] = now.isoformat()
+    poll['end_time'] = tomorrow.isoformat()
+    poll['select_min'] = 1
+    poll['select_max'] = 1
+    poll['options'] = ['Yes', 'No', 'Abstain']
+    return poll
+
+# Returns a random member with one to five contacts as accepted by
+# POST /members.
+def generate_member():
+    member = {}
+    member['name'] = random_string(10)
+    member['group'] = random_string(10)
+    numcontacts = random.randint(1, 5)
+    member['contacts'] = []
+    for i in xrange(0, numcontacts):
+        contact = {}
+        contact['name'] = random_string(10)
+        contact['email'] = random_string(7) + '@example.com'
+        member['contacts'].append(contact)
+    return member
+
+# Yields count random members spread over the given number of groups, like
+# the delegations of a real organization.
+def generate_members(count, groups=20):
+    names = [random_string(10) for _ in xrange(0, groups)]
+    for i in xrange(0, count):
+        member = generate_member()
+        member['group'] = names[i % groups]
+        yield member
+
+def random_string(length):
+    return ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(length))
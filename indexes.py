@@ -0,0 +1,90 @@
+from sqlalchemy import inspect
+import re
+import models
+from app import db
+
+# Constraints added after the tables were first created, as (name, table,
+# columns) tuples. SQLite can't add constraints to existing tables, so they
+# are added as the equivalent unique indexes. New databases get the real
+# constraints from db.create_all().
+CONSTRAINT_INDEXES = [
+    ('uq_vote_code_id', 'vote', ('code_id',)),
+    ('uq_code_poll_id_member_id', 'code', ('poll_id', 'member_id')),
+    ('uq_vote_option_vote_id_option_id', 'vote_option', ('vote_id', 'option_id')),
+]
+
+# Adds the indexes and constraints of the models that are missing from an
+# existing database. sqlalchemy-migrate's generated migrations only add tables
+# and columns, so db_migrate.py and db_upgrade.py call this afterwards.
+# Returns the names of the created indexes.
+def ensure_indexes(engine):
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    created = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+
+    for name, table, columns in CONSTRAINT_INDEXES:
+        if table not in tables:
+            continue
+        # Skip constraints that already exist in any form.
+        unique = [tuple(inspector.get_pk_constraint(table)['constrained_columns'])]
+        unique.extend(tuple(c['column_names']) for c in inspector.get_unique_constraints(table))
+        unique.extend(tuple(i['column_names']) for i in inspector.get_indexes(table) if i['unique'])
+        if columns in unique:
+            continue
+        engine.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (name, table, ', '.join(columns)))
+        created.append(name)
+    return created
+
+# The queries on the hot paths of the API, with representative parameters.
+def hot_queries():
+    Code = models.Code
+    Contact = models.Contact
+    Member = models.Member
+    Option = models.Option
+    Poll = models.Poll
+    Tally = models.Tally
+    Vote = models.Vote
+    vote_option = models.vote_option
+    return [
+        ('poll by organizer', Poll.query.filter_by(organizer_id=1, id=1)),
+        ('polls of organizer', Poll.query.filter_by(organizer_id=1)),
+        ('options of polls', Option.query.filter(Option.poll_id.in_([1, 2]))),
+        ('code lookup', Code.lookup('abcdefghij')),
+        ('codes of members', db.session.query(Code.id).filter(Code.poll_id == 1, Code.member_id.in_([1, 2]))),
+        ('codes of poll', Code.query.filter(Code.poll_id == 1, Code.id > 0).order_by(Code.id)),
+        ('votes page', Vote.query.filter(Vote.poll_id == 1, Vote.id > 0).order_by(Vote.id).limit(101)),
+        ('options of votes', db.session.query(vote_option.c.vote_id, Option.id)
+            .join(Option, Option.id == vote_option.c.option_id)
+            .filter(vote_option.c.vote_id.in_([1, 2]))),
+        ('vote counts', db.session.query(vote_option.c.option_id, db.func.count(vote_option.c.vote_id))
+            .join(Vote, Vote.id == vote_option.c.vote_id)
+            .filter(Vote.poll_id == 1)
+            .group_by(vote_option.c.option_id)),
+        ('tallies of poll', db.session.query(Tally.option_id, Tally.votes).filter(Tally.poll_id == 1)),
+        ('members page', Member.query.filter(Member.organizer_id == 1, Member.id > 0).order_by(Member.id).limit(101)),
+        ('members of group', db.session.query(Member.id).filter(Member.organizer_id == 1, Member.group == 'group')),
+        ('contacts of members', Contact.query.filter(Contact.member_id.in_([1, 2]))),
+    ]
+
+# A step of an SQLite query plan that reads a whole table.
+TABLE_SCAN = re.compile(r'^SCAN (TABLE )?\w+( AS \w+)?$')
+
+# Runs EXPLAIN QUERY PLAN for every hot query on SQLite.
+# Returns a list of (name, plan step) tuples for every full table scan.
+def table_scans():
+    scans = []
+    for name, query in hot_queries():
+        statement = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+        for row in db.session.execute('EXPLAIN QUERY PLAN ' + str(statement)):
+            detail = row[-1]
+            if TABLE_SCAN.match(detail):
+                scans.append((name, detail))
+    return scans
@@ -0,0 +1,96 @@
+from Queue import Queue
+import json
+import threading
+import models
+from app import app, db
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Runs jobs on a pool of worker threads so long running operations don't tie
+# up the request handlers. The threads are started with the first job.
+class JobRunner(object):
+    def __init__(self):
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in xrange(app.config['JOB_WORKERS']):
+                thread = threading.Thread(target=self._work, name='job-worker-%d' % (i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job_id, func, args = self._queue.get()
+            try:
+                with app.app_context():
+                    try:
+                        run(job_id, func, args)
+                    finally:
+                        db.session.remove()
+            except Exception, e:
+                app.logger.exception('Job %d could not be run', job_id)
+
+    def enqueue(self, job_id, func, args):
+        self._start()
+        self._queue.put((job_id, func, args))
+
+runner = JobRunner()
+
+# Reports the progress of a job. The progress is saved right away on a
+# connection of its own, so other requests see it while the job is running.
+# Jobs must commit their work before reporting progress, since on SQLite the
+# update would otherwise wait for the job's own write lock.
+class Progress(object):
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def __call__(self, progress, total=None):
+        values = {'progress': progress}
+        if total is not None:
+            values['total'] = total
+        table = models.Job.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.id == self.job_id).values(**values))
+
+# Runs a job and saves its outcome. func is called with a Progress object
+# followed by args and must return something that can be converted to JSON.
+def run(job_id, func, args):
+    job = models.Job.query.get(job_id)
+    job.status = RUNNING
+    db.session.commit()
+    try:
+        result = func(Progress(job_id), *args)
+        job = models.Job.query.get(job_id)
+        job.status = DONE
+        job.result = json.dumps(result)
+        db.session.commit()
+    except Exception, e:
+        db.session.rollback()
+        app.logger.exception('Job %d failed', job_id)
+        job = models.Job.query.get(job_id)
+        job.status = FAILED
+        job.error = str(e)
+        db.session.commit()
+
+# Creates a job for the organizer and runs it in the background.
+# With JOBS_INLINE set, which the tests use, the job runs before returning.
+# Returns the job.
+def submit(organizer, kind, func, *args):
+    job = models.Job(kind=kind, status=PENDING)
+    job.organizer_id = organizer.id
+    db.session.add(job)
+    db.session.commit()
+    if app.config.get('JOBS_INLINE'):
+        run(job.id, func, args)
+    else:
+        runner.enqueue(job.id, func, args)
+    return job
@@ -0,0 +1,206 @@
+from email.mime.text import MIMEText
+from email.header import Header
+from email.utils import formatdate
+from Queue import Queue, Empty
+from string import Template
+from contextlib import contextmanager
+import smtplib
+import threading
+import time
+import models
+from app import app, db
+
+# The number of codes read from the database and sent at a time.
+DISPATCH_BATCH_SIZE = 200
+
+SENT = 'sent'
+FAILED = 'failed'
+
+DEFAULT_SUBJECT = 'Your voting code for: $question'
+DEFAULT_BODY = '''Dear $contact,
+
+$organizer has invited $member to vote in the following poll:
+
+$question
+
+The poll is open from $start_time to $end_time. Your voting code is:
+
+$code
+'''
+
+# The placeholders that can be used in message templates.
+TEMPLATE_FIELDS = ['code', 'member', 'contact', 'organizer', 'question', 'start_time', 'end_time']
+
+# A pool of persistent SMTP connections.
+# At most size connections are open at the same time. Connections are opened
+# when needed and reused until they fail.
+class SMTPPool(object):
+    def __init__(self, config, size):
+        self.config = config
+        self.size = size
+        self._idle = Queue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        config = self.config
+        connection = smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=config['MAIL_TIMEOUT'])
+        if config['MAIL_USE_TLS']:
+            connection.starttls()
+        if config['MAIL_USERNAME']:
+            connection.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        return connection
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                connection = self._connect()
+            try:
+                yield connection
+            except (smtplib.SMTPException, IOError), e:
+                # Don't reuse a connection that may be broken.
+                self._discard(connection)
+                raise
+            self._idle.put(connection)
+        finally:
+            self._slots.release()
+
+    def _discard(self, connection):
+        try:
+            connection.quit()
+        except Exception, e:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except Empty:
+                break
+
+# Sends a message over the pool, retrying with exponential backoff.
+# Returns None on success or the last error message.
+def send(pool, sender, recipients, message, retries, backoff):
+    error = None
+    for attempt in xrange(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            with pool.connection() as connection:
+                connection.sendmail(sender, recipients, message)
+            return None
+        except (smtplib.SMTPException, IOError), e:
+            error = str(e) or e.__class__.__name__
+            # The server won't change its mind about the recipients.
+            if isinstance(e, smtplib.SMTPRecipientsRefused):
+                break
+    return error
+
+# Sends all messages concurrently over the pool.
+# Takes a list of (code id, recipients, message) tuples and returns a list of
+# (code id, error) tuples, where error is None for delivered messages.
+def send_all(pool, sender, messages, retries, backoff):
+    work = Queue()
+    for item in messages:
+        work.put(item)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                code_id, recipients, message = work.get_nowait()
+            except Empty:
+                return
+            error = send(pool, sender, recipients, message, retries, backoff)
+            with lock:
+                results.append((code_id, error))
+
+    threads = [threading.Thread(target=worker) for i in xrange(min(pool.size, len(messages)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+# Renders the message for a code. The templates are compiled by the caller.
+def render(subject, body, sender, fields, recipients):
+    message = MIMEText(body.safe_substitute(fields).encode('utf-8'), 'plain', 'utf-8')
+    message['Subject'] = Header(subject.safe_substitute(fields), 'utf-8')
+    message['From'] = sender
+    message['To'] = ', '.join(recipients)
+    message['Date'] = formatdate(localtime=True)
+    return message.as_string()
+
+# Emails every member with a code for the poll their voting code.
+# Codes are read in batches together with their members and contacts, sent
+# over a pool of SMTP connections and their delivery status is saved after
+# every batch. Codes that have already been sent are skipped unless resend is
+# true.
+# Returns the number of sent and failed messages.
+def dispatch(poll_id, subject=DEFAULT_SUBJECT, body=DEFAULT_BODY, resend=False, progress=None):
+    config = app.config
+    sender = config['MAIL_SENDER']
+    subject = Template(subject)
+    body = Template(body)
+    poll = models.Poll.query.get(poll_id)
+    poll_fields = {
+        'organizer': poll.organizer.name,
+        'question': poll.question,
+        'start_time': poll.start_time.isoformat(),
+        'end_time': poll.end_time.isoformat(),
+    }
+
+    query = models.Code.query.filter(models.Code.poll_id == poll_id) \
+        .options(db.joinedload('member').selectinload('contacts'))
+    if not resend:
+        query = query.filter(db.or_(models.Code.email_status == None, models.Code.email_status != SENT))
+    total = query.count()
+
+    report = {SENT: 0, FAILED: 0}
+    pool = SMTPPool(config, config['MAIL_POOL_SIZE'])
+    last_id = 0
+    try:
+        while True:
+            codes = query.filter(models.Code.id > last_id).order_by(models.Code.id).limit(DISPATCH_BATCH_SIZE).all()
+            if not codes:
+                break
+            last_id = codes[-1].id
+            messages = []
+            statuses = []
+            for code in codes:
+                contacts = code.member.contacts if code.member else []
+                recipients = [contact.email for contact in contacts if contact.email]
+                if not recipients:
+                    statuses.append((code.id, 'The member has no contact email addresses'))
+                    continue
+                fields = dict(poll_fields)
+                fields['code'] = code.code
+                fields['member'] = code.member.name
+                fields['contact'] = ', '.join(contact.name or contact.email for contact in contacts)
+                messages.append((code.id, recipients, render(subject, body, sender, fields, recipients)))
+            statuses.extend(send_all(pool, sender, messages, config['MAIL_RETRIES'], config['MAIL_BACKOFF']))
+
+            save_statuses(statuses)
+            for code_id, error in statuses:
+                report[FAILED if error else SENT] += 1
+            db.session.commit()
+            if progress:
+                progress(report[SENT] + report[FAILED], total)
+    finally:
+        pool.close()
+    return report
+
+# Saves the delivery status of a batch of codes with one statement.
+def save_statuses(statuses):
+    table = models.Code.__table__
+    statement = table.update() \
+        .where(table.c.id == db.bindparam('code_id')) \
+        .values(email_status=db.bindparam('status'), email_error=db.bindparam('error'),
+            emailed_on=db.func.now())
+    db.session.execute(statement, [
+        {'code_id': code_id, 'status': FAILED if error else SENT, 'error': error}
+        for code_id, error in statuses])
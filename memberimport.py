@@ -0,0 +1,202 @@
+from sqlalchemy.exc import IntegrityError
+import models
+from app import db
+from util import chunked
+
+# The number of members saved in a single transaction.
+IMPORT_CHUNK_SIZE = 500
+
+CREATED = 'created'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+REMOVED = 'removed'
+# Members missing from a synced sheet are kept if they have voting codes.
+KEPT = 'kept'
+
+# Saves the members yielded by xlprsr.parse_file for the organizer.
+# Members are saved in chunks with bulk inserts and every chunk is committed on
+# its own, so a duplicate or invalid row doesn't fail the whole import.
+# Returns a report with the number of created, duplicate and invalid members
+# and the outcome of every member.
+# If given, progress is called with the number of members handled after every
+# chunk.
+def import_members(organizer, rows, progress=None):
+    report = {CREATED: 0, DUPLICATE: 0, INVALID: 0, 'rows': []}
+    for chunk in chunked(rows, IMPORT_CHUNK_SIZE):
+        for outcome in import_chunk(organizer, chunk):
+            report[outcome['status']] += 1
+            report['rows'].append(outcome)
+        if progress:
+            progress(len(report['rows']))
+    return report
+
+# Saves a chunk of members and returns their outcomes.
+def import_chunk(organizer, chunk):
+    try:
+        outcomes = save_chunk(organizer, chunk)
+        db.session.commit()
+        return outcomes
+    except IntegrityError, e:
+        # Someone else saved one of the names meanwhile. Start over, the
+        # duplicate will now be found up front.
+        db.session.rollback()
+        outcomes = save_chunk(organizer, chunk)
+        db.session.commit()
+        return outcomes
+
+def save_chunk(organizer, chunk):
+    outcomes = []
+    valid = []
+    for row, member, error in chunk:
+        if error:
+            outcomes.append(row_outcome(row, member, INVALID, error))
+        else:
+            valid.append((row, member))
+
+    # Member names are unique, so look up the names of the chunk at once.
+    names = [member['name'] for row, member in valid]
+    existing = set()
+    if names:
+        query = db.session.query(models.Member.name).filter(models.Member.name.in_(names))
+        existing = set(name for (name,) in query)
+
+    new = []
+    for row, member in valid:
+        if member['name'] in existing:
+            outcomes.append(row_outcome(row, member, DUPLICATE, 'A member with this name already exists'))
+        else:
+            existing.add(member['name'])
+            new.append((row, member))
+            outcomes.append(row_outcome(row, member, CREATED))
+    if new:
+        insert_members(organizer, [member for row, member in new])
+    outcomes.sort(key=lambda outcome: outcome['row'])
+    return outcomes
+
+# Makes the members of the organizer match the members yielded by
+# xlprsr.parse_file.
+# The existing members and contacts are read with one query each and compared
+# in memory, so only members that actually changed are written. New members
+# are inserted, changed members get their group and contacts replaced and
+# members missing from the sheet are removed, unless they have voting codes.
+# Returns a report like import_members and reports progress the same way.
+def sync_members(organizer, rows, progress=None):
+    report = {CREATED: 0, DUPLICATE: 0, INVALID: 0, UPDATED: 0, UNCHANGED: 0, REMOVED: 0, KEPT: 0, 'rows': []}
+    existing = {}
+    query = db.session.query(models.Member.name, models.Member.id, models.Member.group) \
+        .filter(models.Member.organizer_id == organizer.id)
+    for name, member_id, group in query:
+        existing[name] = (member_id, group)
+    contacts = {}
+    query = db.session.query(models.Contact.member_id, models.Contact.name, models.Contact.email) \
+        .join(models.Member, models.Member.id == models.Contact.member_id) \
+        .filter(models.Member.organizer_id == organizer.id)
+    for member_id, name, email in query:
+        contacts.setdefault(member_id, set()).add((name, email))
+
+    seen = set()
+    for chunk in chunked(rows, IMPORT_CHUNK_SIZE):
+        outcomes = []
+        new = []
+        changed = []
+        for row, member, error in chunk:
+            if error:
+                # A member whose row is invalid is still in the sheet, so it
+                # must not be removed.
+                if member and member.get('name'):
+                    seen.add(member['name'])
+                outcomes.append(row_outcome(row, member, INVALID, error))
+            elif member['name'] in seen:
+                outcomes.append(row_outcome(row, member, DUPLICATE, 'The member appears more than once in the sheet'))
+            elif member['name'] not in existing:
+                seen.add(member['name'])
+                new.append((row, member, None))
+            else:
+                seen.add(member['name'])
+                member_id, group = existing[member['name']]
+                new_contacts = set((c['name'], c['email']) for c in member['contacts'])
+                if group == member['group'] and contacts.get(member_id, set()) == new_contacts:
+                    outcomes.append(row_outcome(row, member, UNCHANGED))
+                else:
+                    changed.append((member_id, member))
+                    outcomes.append(row_outcome(row, member, UPDATED))
+        # New names may still belong to another organizer.
+        if new:
+            outcomes.extend(save_chunk(organizer, new))
+        if changed:
+            update_members(changed)
+        db.session.commit()
+        for outcome in sorted(outcomes, key=lambda outcome: outcome['row']):
+            report[outcome['status']] += 1
+            report['rows'].append(outcome)
+        if progress:
+            progress(len(report['rows']))
+
+    missing = [(name, existing[name][0]) for name in existing if name not in seen]
+    for outcome in remove_members(missing):
+        report[outcome['status']] += 1
+        report['rows'].append(outcome)
+    db.session.commit()
+    return report
+
+# Replaces the group and contacts of existing members with bulk statements.
+def update_members(changed):
+    table = models.Member.__table__
+    statement = table.update() \
+        .where(table.c.id == db.bindparam('member_id')) \
+        .values(group=db.bindparam('new_group'))
+    db.session.execute(statement, [{'member_id': member_id, 'new_group': member['group']} for member_id, member in changed])
+    member_ids = [member_id for member_id, member in changed]
+    models.Contact.query.filter(models.Contact.member_id.in_(member_ids)).delete(synchronize_session=False)
+    rows = []
+    for member_id, member in changed:
+        for contact in member['contacts']:
+            rows.append({'name': contact['name'], 'email': contact['email'], 'member_id': member_id})
+    if rows:
+        db.session.execute(models.Contact.__table__.insert(), rows)
+
+# Removes the given members, except those that have voting codes.
+# Returns their outcomes.
+def remove_members(members):
+    outcomes = []
+    for chunk in chunked(members, IMPORT_CHUNK_SIZE):
+        member_ids = [member_id for name, member_id in chunk]
+        query = db.session.query(models.Code.member_id).filter(models.Code.member_id.in_(member_ids))
+        has_codes = set(member_id for (member_id,) in query)
+        removed = [member_id for member_id in member_ids if member_id not in has_codes]
+        if removed:
+            models.Contact.query.filter(models.Contact.member_id.in_(removed)).delete(synchronize_session=False)
+            models.Member.query.filter(models.Member.id.in_(removed)).delete(synchronize_session=False)
+        for name, member_id in chunk:
+            if member_id in has_codes:
+                outcomes.append(row_outcome(None, {'name': name}, KEPT, 'The member has voting codes'))
+            else:
+                outcomes.append(row_outcome(None, {'name': name}, REMOVED))
+    return outcomes
+
+# Inserts the members and their contacts with one statement each.
+def insert_members(organizer, members):
+    db.session.execute(models.Member.__table__.insert(), [
+        {'name': member['name'], 'group': member['group'], 'organizer_id': organizer.id}
+        for member in members])
+    # Read the new members back to get their ids.
+    query = db.session.query(models.Member.name, models.Member.id) \
+        .filter(models.Member.name.in_([member['name'] for member in members]))
+    ids = dict(query)
+    contacts = []
+    for member in members:
+        for contact in member['contacts']:
+            contacts.append({'name': contact['name'], 'email': contact['email'], 'member_id': ids[member['name']]})
+    if contacts:
+        db.session.execute(models.Contact.__table__.insert(), contacts)
+
+def row_outcome(row, member, status, message=None):
+    outcome = {}
+    outcome['row'] = row
+    outcome['name'] = member['name'] if member else None
+    outcome['status'] = status
+    if message:
+        outcome['message'] = message
+    return outcome
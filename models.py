@@ -1,8 +1,27 @@
-from app import db
+from app import app, db
 import json
+import hashlib
 from passlib.apps import custom_app_context as password_context
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from itsdangerous import BadSignature, SignatureExpired
+from sqlalchemy.orm import joinedload, selectinload
 from datetime import datetime
 
+# Models mix this in to declare the relationships their to_dict() walks, as
+# (relationship, strategy) pairs. List queries built with query_serializable()
+# then load those relationships eagerly instead of once per row.
+class Serializable(object):
+    serialize_relationships = ()
+
+    @classmethod
+    def serialize_options(cls):
+        loaders = {'joined': joinedload, 'selectin': selectinload}
+        return [loaders[strategy](name) for name, strategy in cls.serialize_relationships]
+
+    @classmethod
+    def query_serializable(cls):
+        return cls.query.options(*cls.serialize_options())
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), index=True, unique=True)
@@ -17,9 +36,41 @@ class User(db.Model):
     def verify_password(self, password):
         return password_context.verify(password, self.password_hash)
 
+    # Replace the saved hash with a hash of the given plaintext password.
+    def set_password(self, password):
+        self.password_hash = password_context.encrypt(password)
+
+    # A short fingerprint of the password hash. Embedded in tokens so that
+    # changing the password revokes all tokens issued before the change.
+    def password_stamp(self):
+        return hashlib.sha256(self.password_hash).hexdigest()[:16]
+
+    # Returns a signed token that authenticates this user until it expires.
+    def generate_auth_token(self, expiration=None):
+        if expiration is None:
+            expiration = app.config['TOKEN_EXPIRATION']
+        s = Serializer(app.config['SECRET_KEY'], expires_in=expiration)
+        return s.dumps({'id': self.id, 'stamp': self.password_stamp()})
+
+    # Returns the user the given token was issued to, or None if the token is
+    # invalid, expired or was revoked by a password change.
+    @staticmethod
+    def verify_auth_token(token):
+        s = Serializer(app.config['SECRET_KEY'])
+        try:
+            data = s.loads(token)
+        except (SignatureExpired, BadSignature):
+            return None
+        if not isinstance(data, dict) or 'id' not in data:
+            return None
+        user = User.query.options(db.joinedload('organizer')).get(data['id'])
+        if user == None or data.get('stamp') != user.password_stamp():
+            return None
+        return user
+
     def __init__(self, username, password, is_admin=False):
         self.username = username
-        self.password_hash = password_context.encrypt(password)
+        self.set_password(password)
         self.is_admin = is_admin
 
     def __repr__(self):
@@ -39,6 +90,9 @@ class Organizer(db.Model):
     user = db.relationship('User', backref=db.backref('organizer', uselist=False), uselist=False)
     members = db.relationship('Member', backref=db.backref('organizer', uselist=False), lazy='dynamic')
     polls = db.relationship('Poll', backref=db.backref('organizer', uselist=False), lazy='dynamic')
+    # Incremented whenever a poll of the organizer is created, edited or
+    # deleted. Identifies the version of the poll list in ETags.
+    polls_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     created_on = db.Column(db.DateTime, server_default=db.func.now())
     updated_on = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
@@ -55,7 +109,11 @@ class Organizer(db.Model):
         data['name'] = self.name
         return data
 
-class Member(db.Model):
+class Member(db.Model, Serializable):
+    serialize_relationships = (('contacts', 'selectin'),)
+    # Members are listed by organizer in id order.
+    __table_args__ = (db.Index('ix_member_organizer_id_id', 'organizer_id', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), index=True, unique=True)
     group = db.Column(db.String(120), index=True)
@@ -86,7 +144,7 @@ class Contact(db.Model):
     name = db.Column(db.String(120), index=True)
     email = db.Column(db.String(80), index=True)
 
-    member_id = db.Column(db.Integer, db.ForeignKey('member.id'))
+    member_id = db.Column(db.Integer, db.ForeignKey('member.id'), index=True)
 
     created_on = db.Column(db.DateTime, server_default=db.func.now())
     updated_on = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
@@ -101,7 +159,11 @@ class Contact(db.Model):
         data['email'] = self.email
         return data
 
-class Poll(db.Model):
+class Poll(db.Model, Serializable):
+    serialize_relationships = (('organizer', 'joined'), ('options', 'selectin'))
+    # Polls are looked up by organizer and id.
+    __table_args__ = (db.Index('ix_poll_organizer_id_id', 'organizer_id', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     start_time = db.Column(db.DateTime)
     end_time = db.Column(db.DateTime)
@@ -113,6 +175,9 @@ class Poll(db.Model):
     options = db.relationship('Option', backref='poll')
     codes = db.relationship('Code', backref='poll', lazy='dynamic')
     votes = db.relationship('Vote', backref='poll', lazy='dynamic')
+    # Incremented on every edit. updated_on only has a resolution of a second,
+    # so it can't tell edits apart.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     created_on = db.Column(db.DateTime, server_default=db.func.now())
     updated_on = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
@@ -126,8 +191,8 @@ class Poll(db.Model):
         data['question'] = self.question
         data['select_min'] = self.select_min
         data['select_max'] = self.select_max
-        data['start_time'] = self.start_time.isoformat()
-        data['end_time'] = self.end_time.isoformat()
+        data['start_time'] = self.start_time
+        data['end_time'] = self.end_time
         data['organizer'] = self.organizer.to_dict()
         data['options'] = []
         for option in self.options:
@@ -135,6 +200,9 @@ class Poll(db.Model):
         return data
 
 class Option(db.Model):
+    # Options are looked up by poll.
+    __table_args__ = (db.Index('ix_option_poll_id_id', 'poll_id', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     option = db.Column(db.String(120))
     poll_id = db.Column(db.Integer, db.ForeignKey('poll.id'))
@@ -155,6 +223,10 @@ class Option(db.Model):
         return data
 
 class Code(db.Model):
+    # A member can only have one code per poll. The constraint's index also
+    # serves lookups by poll.
+    __table_args__ = (db.UniqueConstraint('poll_id', 'member_id', name='uq_code_poll_id_member_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(30), index=True, unique=True)
 
@@ -162,22 +234,45 @@ class Code(db.Model):
     member_id = db.Column(db.Integer, db.ForeignKey('member.id'))
     vote = db.relationship('Vote', backref='code', uselist=False)
 
+    # The delivery status of the email with the code. See mailer.py.
+    email_status = db.Column(db.String(20), index=True)
+    email_error = db.Column(db.Text)
+    emailed_on = db.Column(db.DateTime)
+
     created_on = db.Column(db.DateTime, server_default=db.func.now())
     updated_on = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
 
     def __repr__(self):
         return '<Code %r>' % (self.code)
 
+    # Returns a query for the poll id of the code with the given token, the
+    # version and creation time of the poll and the id of the vote cast with
+    # the code, if any. Poll ids can be reused after a delete, so the creation
+    # time is part of the version.
+    @staticmethod
+    def lookup(token):
+        return db.session.query(Code.poll_id, Poll.version, Poll.created_on, Vote.id) \
+            .join(Poll, Code.poll_id == Poll.id) \
+            .outerjoin(Vote, Vote.code_id == Code.id) \
+            .filter(Code.code == token)
+
     def to_dict(self):
         data = {}
         data['id'] = self.id
         data['code'] = self.code
+        data['email_status'] = self.email_status
         return data
 
-class Vote(db.Model):
+class Vote(db.Model, Serializable):
+    serialize_relationships = (('code', 'joined'), ('options', 'selectin'))
+    # Votes are listed by poll in id order.
+    __table_args__ = (db.Index('ix_vote_poll_id_id', 'poll_id', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     time = db.Column(db.DateTime)
-    code_id = db.Column(db.Integer, db.ForeignKey('code.id'))
+    # A code can only be used once. The constraint makes casting a vote a
+    # single conditional write, even with concurrent submissions.
+    code_id = db.Column(db.Integer, db.ForeignKey('code.id'), unique=True)
     member_id = db.Column(db.Integer, db.ForeignKey('member.id'))
     poll_id = db.Column(db.Integer, db.ForeignKey('poll.id'))
     options = db.relationship('Option', secondary='vote_option', backref=db.backref('votes', lazy='dynamic'))
@@ -196,9 +291,54 @@ class Vote(db.Model):
             data['options'].append(option.to_dict())
         return data
 
+# A long running operation that runs in the background. See jobs.py.
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40))
+    status = db.Column(db.String(20), index=True)
+    progress = db.Column(db.Integer, default=0)
+    total = db.Column(db.Integer)
+    # JSON encoded.
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+
+    organizer_id = db.Column(db.Integer, db.ForeignKey('organizer.id'), index=True)
+
+    created_on = db.Column(db.DateTime, server_default=db.func.now())
+    updated_on = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+    def __repr__(self):
+        return '<Job %r %r>' % (self.kind, self.status)
+
+    def to_dict(self):
+        data = {}
+        data['id'] = self.id
+        data['kind'] = self.kind
+        data['status'] = self.status
+        data['progress'] = self.progress
+        data['total'] = self.total
+        data['result'] = None
+        if self.result is not None:
+            data['result'] = json.loads(self.result)
+        data['error'] = self.error
+        return data
+
+# The live number of votes for an option.
+# Maintained in the same transaction as casting and voiding votes, so reading
+# the results of a poll doesn't require counting its votes.
+class Tally(db.Model):
+    option_id = db.Column(db.Integer, db.ForeignKey('option.id'), primary_key=True)
+    poll_id = db.Column(db.Integer, db.ForeignKey('poll.id'), index=True)
+    votes = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<Tally %r: %r>' % (self.option_id, self.votes)
+
 # A relational table between votes and options.
 vote_option = db.Table('vote_option',
-    db.Column('vote_id', db.Integer, db.ForeignKey('vote.id')),
-    db.Column('option_id', db.Integer, db.ForeignKey('option.id'))
+    db.Column('vote_id', db.Integer, db.ForeignKey('vote.id'), primary_key=True),
+    db.Column('option_id', db.Integer, db.ForeignKey('option.id'), primary_key=True),
+    # Votes are counted by option.
+    db.Index('ix_vote_option_option_id', 'option_id')
 )
 
@@ -5,6 +5,23 @@ import string
 from datetime import datetime, timedelta
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.exc import MultipleResultsFound
+from string import Template
+from util import chunked
+import mailer
+
+# The maximum number of values in a single IN clause. SQLite allows at most 999
+# variables in a statement.
+IN_CHUNK_SIZE = 500
+
+# The number of items in a page of a listing unless the client asks otherwise.
+DEFAULT_PAGE_SIZE = 100
+# The maximum number of items in a page of a listing.
+MAX_PAGE_SIZE = 1000
+
+# Reported when a voting code has already been used to cast a vote.
+CODE_USED_ERROR = 'This voting code has already been used'
+# Reported when codes are requested for members that already have one.
+CODE_EXISTS_ERROR = 'At least one member already has a code for this poll'
 
 # Returns a 2-tuple.
 # Either a poll object and None or None and a dictionary of error messages.
@@ -147,10 +164,10 @@ def parse_vote(json, poll):
 
     if code:
         # Check if the code is for this poll.
-        if code.poll != poll:
+        if code.poll_id != poll.id:
             error['code'] = 'This voting code is invalid'
         elif code.vote:
-            error['code'] = 'This voting code has already been used'
+            error['code'] = CODE_USED_ERROR
 
     # Don't provide further error messages if there is a problem with the code.
     if error:
@@ -160,23 +177,26 @@ def parse_vote(json, poll):
         options = json['options']
         if not isinstance(options, list):
             error['options'] = 'Options must be provided in a list'
-        elif len(options) < poll.select_min:
-            error['options'] = 'There must be at least %d options' % (poll.select_min)
-        elif len(options) < poll.select_max:
-            error['options'] = 'There can at most be %d options' % (poll.select_max)
-
-        # Check for duplicate options.
-        elif len(options) != len(set(options)):
-            error['options'] = 'The options must be unique'
         else:
-            for o in options:
-                option_id = int(o)
-                try:
-                    option = models.Option.query.filter_by(id=option_id, poll=poll).one()
-                    vote.options.append(option)
-                except (NoResultFound, MultipleResultsFound), e:
+            option_ids = [int(o) for o in options]
+            if len(option_ids) < poll.select_min:
+                error['options'] = 'There must be at least %d options' % (poll.select_min)
+            elif len(option_ids) > poll.select_max:
+                error['options'] = 'There can at most be %d options' % (poll.select_max)
+
+            # Check for duplicate options.
+            elif len(option_ids) != len(set(option_ids)):
+                error['options'] = 'The options must be unique'
+            else:
+                # Load the options of the poll once and validate the selection
+                # in memory instead of querying for every selected option.
+                poll_options = dict((option.id, option) for option in poll.options)
+                if not all(option_id in poll_options for option_id in option_ids):
                     error['options'] = 'One or more options are invalid'
-    except ValueError, e:
+                else:
+                    for option_id in option_ids:
+                        vote.options.append(poll_options[option_id])
+    except (ValueError, TypeError), e:
         error['options'] = 'The options must be a list of valid integers'
     except KeyError, e:
         error['options'] = 'The \'options\' parameter is required'
@@ -244,36 +264,154 @@ def parse_member(json):
         return None, error
     return member, None
 
+# Parses the keyset pagination parameters of a listing.
+# Returns a 2-tuple.
+# Either a tuple of the id to list after and the page size and None or None and
+# a dictionary of error messages.
+def parse_page(args):
+    after_id = 0
+    limit = DEFAULT_PAGE_SIZE
+    error = {}
+    try:
+        after_id = int(args.get('after_id', 0))
+        if after_id < 0:
+            error['after_id'] = 'The after_id parameter cannot be negative'
+    except ValueError, e:
+        error['after_id'] = 'The after_id parameter must be an integer'
+
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            error['limit'] = 'The limit parameter must be between 1 and %d' % (MAX_PAGE_SIZE)
+    except ValueError, e:
+        error['limit'] = 'The limit parameter must be an integer'
+
+    if error:
+        return None, error
+    return (after_id, limit), None
+
+# Parses a request to email the voting codes of a poll.
+# Returns a 2-tuple.
+# Either a dictionary of arguments for mailer.dispatch and None or None and a
+# dictionary of error messages.
+def parse_emails(json):
+    emails = {}
+    error = {}
+    if not isinstance(json, dict):
+        error['message'] = 'The request must be a JSON object'
+        return None, error
+
+    for field in ['subject', 'body']:
+        if field not in json:
+            continue
+        template = json[field]
+        if not isinstance(template, basestring) or not template.strip():
+            error[field] = 'The %s must be a non-empty string' % (field)
+            continue
+        # Make sure the template only uses known placeholders.
+        try:
+            Template(template).substitute(dict((name, '') for name in mailer.TEMPLATE_FIELDS))
+            emails[field] = template
+        except (KeyError, ValueError), e:
+            error[field] = 'The %s can only contain the placeholders: %s' % (field, ', '.join('$' + name for name in mailer.TEMPLATE_FIELDS))
+    resend = json.get('resend', False)
+    if isinstance(resend, bool):
+        emails['resend'] = resend
+    else:
+        error['resend'] = 'Resend must be true or false'
+
+    if error:
+        return None, error
+    return emails, None
+
+# Returns True if a form or query string value switches an option on.
+def parse_flag(value):
+    return value is not None and value.lower() in ['1', 'true', 'yes']
+
+# Escapes the wildcards of a LIKE pattern so the value only matches itself.
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Codes can either be created for a list of members with 'member_ids' or for
+# every member of a group that doesn't already have a code with 'group'.
 def parse_codes(json, poll):
-    codes = []
+    if 'group' in json and 'member_ids' not in json:
+        return parse_group_codes(json, poll)
+
     error = {}
+    member_ids = []
     try:
         member_ids = json['member_ids']
         if not isinstance(member_ids, list):
             error['member_ids'] = 'Member ids must be provided in a list'
         elif not member_ids:
             error['member_ids'] = 'At least one member id must be specified'
-        elif len(member_ids) != len(set(member_ids)):
-            error['member_ids'] = 'You cannot create multiple codes for the same member'
         else:
-            for member_id_str in member_ids:
-                member_id = int(member_id_str)
-                member = models.Member.query.filter_by(id=member_id, organizer=poll.organizer).one()
-                if models.Code.query.filter_by(poll=poll, member=member).first():
-                    error['member_ids'] = 'At least one member already has a code for this poll'
-                    break
-                code = models.Code()
-                code.poll = poll
-                code.member = member
-                codes.append(code)
-    except ValueError, e:
+            member_ids = [int(member_id) for member_id in member_ids]
+            if len(member_ids) != len(set(member_ids)):
+                error['member_ids'] = 'You cannot create multiple codes for the same member'
+    except (ValueError, TypeError), e:
         error['member_ids'] = 'The member_ids must be a valid integer'
     except KeyError, e:
         error['member_ids'] = 'The \'member_ids\' field is required'
-    except (NoResultFound, MultipleResultsFound), e:
-        error['member_ids'] = 'At least one member id is invalid'
 
     if error:
         return None, error
-    return codes, None
 
+    # Validate all the ids with two IN queries per chunk instead of two
+    # queries per member.
+    found = set()
+    for chunk in chunked(member_ids, IN_CHUNK_SIZE):
+        query = models.Member.query.with_entities(models.Member.id) \
+            .filter(models.Member.organizer_id == poll.organizer_id, models.Member.id.in_(chunk))
+        found.update(member_id for (member_id,) in query)
+    if len(found) != len(member_ids):
+        error['member_ids'] = 'At least one member id is invalid'
+        return None, error
+
+    for chunk in chunked(member_ids, IN_CHUNK_SIZE):
+        query = models.Code.query.with_entities(models.Code.id) \
+            .filter(models.Code.poll_id == poll.id, models.Code.member_id.in_(chunk))
+        if query.first():
+            error['member_ids'] = CODE_EXISTS_ERROR
+            return None, error
+
+    return [new_code(poll, member_id) for member_id in member_ids], None
+
+def parse_group_codes(json, poll):
+    error = {}
+    try:
+        group = json['group']
+        if not isinstance(group, basestring) or not group:
+            error['group'] = 'The group must be a non-empty string'
+            return None, error
+    except KeyError, e:
+        error['group'] = 'The \'group\' field is required'
+        return None, error
+
+    members = models.Member.query.with_entities(models.Member.id) \
+        .filter(models.Member.organizer_id == poll.organizer_id, models.Member.group == group)
+    if not members.first():
+        error['group'] = 'There are no members in this group'
+        return None, error
+
+    # Skip the members that already have a code for this poll. Codes of
+    # deleted members have no member, and a NULL would make NOT IN match
+    # nothing.
+    has_code = models.Code.query.with_entities(models.Code.member_id) \
+        .filter(models.Code.poll_id == poll.id, models.Code.member_id != None)
+    member_ids = [member_id for (member_id,) in members.filter(~models.Member.id.in_(has_code)).order_by(models.Member.id)]
+    if not member_ids:
+        error['group'] = 'Every member in this group already has a code for this poll'
+        return None, error
+
+    return [new_code(poll, member_id) for member_id in member_ids], None
+
+# Returns an unsaved code for the member.
+# Only the ids are set so the code isn't added to the session by relationship
+# cascading. Codes are saved in bulk by the caller.
+def new_code(poll, member_id):
+    code = models.Code()
+    code.poll_id = poll.id
+    code.member_id = member_id
+    return code
@@ -0,0 +1,22 @@
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Count every statement executed while handling a request.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = getattr(g, 'query_count', 0) + 1
+
+# Returns the number of queries executed by the current request so far.
+def query_count():
+    return getattr(g, 'query_count', 0)
+
+def init_app(app):
+    @app.after_request
+    def report_query_count(response):
+        count = query_count()
+        app.logger.debug('%s %s: %d queries', request.method, request.endpoint, count)
+        if app.config.get('QUERY_COUNT_HEADER'):
+            response.headers['X-Query-Count'] = str(count)
+        return response
@@ -0,0 +1,104 @@
+import models
+from app import db
+
+# Returns a dictionary of option id to the number of votes for the option.
+# The votes are counted by the database in a single aggregate query.
+def count_votes(poll_id):
+    vote_option = models.vote_option
+    rows = db.session.query(vote_option.c.option_id, db.func.count(vote_option.c.vote_id)) \
+        .join(models.Vote, models.Vote.id == vote_option.c.vote_id) \
+        .filter(models.Vote.poll_id == poll_id) \
+        .group_by(vote_option.c.option_id)
+    return dict(rows)
+
+# Returns a dictionary of option id to a dictionary of member group to the
+# number of votes from members of that group.
+def count_votes_by_group(poll_id):
+    vote_option = models.vote_option
+    rows = db.session.query(vote_option.c.option_id, models.Member.group, db.func.count(vote_option.c.vote_id)) \
+        .join(models.Vote, models.Vote.id == vote_option.c.vote_id) \
+        .outerjoin(models.Member, models.Member.id == models.Vote.member_id) \
+        .filter(models.Vote.poll_id == poll_id) \
+        .group_by(vote_option.c.option_id, models.Member.group)
+    counts = {}
+    for option_id, group, count in rows:
+        counts.setdefault(option_id, {})[group] = count
+    return counts
+
+# Returns a dictionary of option id to the number of votes for the option, read
+# from the live tallies, or None if the tallies of the poll are incomplete.
+def read_tallies(poll):
+    counts = dict(db.session.query(models.Tally.option_id, models.Tally.votes).filter(models.Tally.poll_id == poll.id))
+    if len(counts) != len(poll.options):
+        return None
+    return counts
+
+# Adds amount to the tallies of the given options of the poll.
+# The caller is responsible for committing, so the tallies change in the same
+# transaction as the votes.
+def add_votes(poll_id, option_ids, amount):
+    if not option_ids:
+        return
+    table = models.Tally.__table__
+    result = db.session.execute(table.update()
+        .where(table.c.option_id.in_(option_ids))
+        .values(votes=table.c.votes + amount))
+    # Polls created before the tallies existed are counted from scratch.
+    if result.rowcount != len(option_ids):
+        rebuild(poll_id)
+
+# Counts a vote that has been flushed but not committed.
+def record_vote(vote):
+    add_votes(vote.poll_id, [option.id for option in vote.options], 1)
+
+# Uncounts a vote for the given options of the poll. Must be called after the
+# vote has been deleted and flushed, otherwise a rebuild would still count it.
+def void_vote(poll_id, option_ids):
+    add_votes(poll_id, option_ids, -1)
+
+# Deletes the tallies of a poll, or of every poll if no poll id is given.
+def clear(poll_id=None):
+    query = models.Tally.query
+    if poll_id is not None:
+        query = query.filter_by(poll_id=poll_id)
+    query.delete(synchronize_session=False)
+
+# Recomputes the tallies of a poll, or of every poll if no poll id is given,
+# from the votes.
+def rebuild(poll_id=None):
+    clear(poll_id)
+    Option = models.Option
+    Vote = models.Vote
+    vote_option = models.vote_option
+    counts = db.select([Option.id, Option.poll_id, db.func.count(Vote.id)]) \
+        .select_from(Option.__table__
+            .outerjoin(vote_option, vote_option.c.option_id == Option.id)
+            .outerjoin(Vote.__table__, Vote.id == vote_option.c.vote_id)) \
+        .group_by(Option.id, Option.poll_id)
+    if poll_id is not None:
+        counts = counts.where(Option.poll_id == poll_id)
+    table = models.Tally.__table__
+    db.session.execute(table.insert().from_select(['option_id', 'poll_id', 'votes'], counts))
+
+# Returns the results of the poll as a dictionary.
+# The counts are read from the live tallies when they are complete.
+# If by_group is true, the votes for each option are also broken down by the
+# group of the voting members.
+def results(poll, by_group=False):
+    counts = read_tallies(poll)
+    if counts is None:
+        counts = count_votes(poll.id)
+    groups = None
+    if by_group:
+        groups = count_votes_by_group(poll.id)
+    data = {}
+    data['poll_id'] = poll.id
+    data['total_votes'] = poll.votes.count()
+    data['options'] = []
+    for option in poll.options:
+        result = option.to_dict()
+        result['votes'] = counts.get(option.id, 0)
+        if groups is not None:
+            result['groups'] = groups.get(option.id, {})
+        data['options'].append(result)
+    return data
@@ -0,0 +1,7 @@
+#!flask/bin/python
+# Recomputes the live vote tallies of every poll from the votes.
+from app import db
+import tally
+tally.rebuild()
+db.session.commit()
+print('Tallies rebuilt')
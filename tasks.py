@@ -0,0 +1,80 @@
+from StringIO import StringIO
+from sqlalchemy.exc import IntegrityError
+import os
+import codegen
+import export
+import mailer
+import memberimport
+import models
+import parser
+import xlprsr
+from app import app, db
+from util import chunked
+
+# Export jobs report their progress every this many lines.
+EXPORT_PROGRESS_LINES = 1000
+
+# The background jobs of the organizer endpoints. Each is called by jobs.run
+# with a Progress object followed by the arguments given to jobs.submit.
+
+def import_members(progress, organizer_id, contents, update):
+    organizer = models.Organizer.query.get(organizer_id)
+    rows, error = xlprsr.parse_file(StringIO(contents))
+    if error:
+        raise ValueError(error['excel_file'])
+    if update:
+        return memberimport.sync_members(organizer, rows, progress)
+    return memberimport.import_members(organizer, rows, progress)
+
+# Codes are committed batch by batch, so the progress can be saved in between.
+def create_codes(progress, poll_id, member_ids):
+    data = {}
+    data['codes'] = []
+    for batch in chunked(member_ids, codegen.BATCH_SIZE):
+        codes = []
+        for member_id in batch:
+            code = models.Code()
+            code.poll_id = poll_id
+            code.member_id = member_id
+            codes.append(code)
+        try:
+            codes = codegen.create_codes(codes)
+        except IntegrityError, e:
+            # Another request gave one of the members a code meanwhile. The
+            # codes of the batches before are kept.
+            db.session.rollback()
+            raise ValueError(parser.CODE_EXISTS_ERROR)
+        # Serialize before committing expires the codes.
+        data['codes'].extend(code.to_dict() for code in codes)
+        db.session.commit()
+        progress(len(data['codes']), len(member_ids))
+    return data
+
+def export_votes(progress, poll_id, format):
+    if not os.path.isdir(app.config['JOB_DIR']):
+        os.makedirs(app.config['JOB_DIR'])
+    filename = export_filename(progress.job_id, format)
+    # One line per vote, plus the header of CSV files.
+    total = models.Vote.query.filter_by(poll_id=poll_id).count()
+    if format == 'csv':
+        total += 1
+    progress(0, total)
+    count = 0
+    with open(os.path.join(app.config['JOB_DIR'], filename), 'wb') as file:
+        for line in export.export_votes(poll_id, format):
+            file.write(line)
+            count += 1
+            if count % EXPORT_PROGRESS_LINES == 0:
+                progress(count)
+    progress(count)
+    data = {}
+    data['file'] = filename
+    data['format'] = format
+    data['lines'] = count
+    return data
+
+def export_filename(job_id, format):
+    return 'job-%d.%s' % (job_id, format)
+
+def send_codes(progress, poll_id, emails):
+    return mailer.dispatch(poll_id, progress=progress, **emails)
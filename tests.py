@@ -4,6 +4,12 @@ import time
 from app import *
 import unittest
 import tempfile
+import asyncore
+import smtpd
+import email
+import threading
+import zlib
+import xlrd
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
 db = SQLAlchemy(app)
@@ -13,11 +19,14 @@ organizer = 'organizer'
 password = 'password'
 
 from models import *
+from fixtures import *
 
 class eVoteTestCase(unittest.TestCase):
 
     def setUp(self):
         app.config['TESTING'] = True
+        app.config['QUERY_COUNT_HEADER'] = True
+        app.config['JOBS_INLINE'] = True
         self.app = app.test_client()
         db.create_all()
 
@@ -45,6 +54,52 @@ class eVoteTestCase(unittest.TestCase):
         assert not js['data']['polls']
 
 
+    # Changing a password must not leave the old one usable through the
+    # credential cache.
+    def test_password_change(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password)}
+        res = self.app.get('/polls', headers=headers)
+        assert res.status_code == 200
+        res = self.app.get('/polls', headers=headers)
+        assert res.status_code == 200
+
+        user = User.query.filter_by(username=organizer).first()
+        user.set_password('new' + password)
+        db.session.commit()
+
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers=dict(headers, **{'Content-Type': 'application/json'}))
+        assert res.status_code == 401
+
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":new" + password)}
+        res = self.app.get('/polls', headers=headers)
+        assert res.status_code == 200
+
+    def test_token(self):
+        # Tokens require a username and password.
+        res = self.app.get('/token')
+        assert res.status_code == 401
+
+        res = self.app.get('/token', headers={'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password)})
+        assert res.status_code == 200
+        token = str(json.loads(res.get_data())['data']['token'])
+
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers={'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'})
+        assert res.status_code == 201
+
+        # A token cannot be used to issue new tokens.
+        res = self.app.get('/token', headers={'Authorization': 'Bearer ' + token})
+        assert res.status_code == 401
+
+        res = self.app.get('/polls', headers={'Authorization': 'Bearer ' + token[:-1]})
+        assert res.status_code == 404
+
+        # Changing the password revokes the token.
+        user = User.query.filter_by(username=organizer).first()
+        user.set_password('new' + password)
+        db.session.commit()
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers={'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'})
+        assert res.status_code == 401
+
     def test_create_poll(self):
         data = generate_poll()
         # Try without authentication.
@@ -157,38 +212,616 @@ class eVoteTestCase(unittest.TestCase):
         res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
         assert res.status_code == 201
 
+    # A code can only be used to vote once.
+    def test_vote_twice(self):
+        poll_id, option_ids, code = self.create_code()
+        vote = {}
+        vote['code'] = code
+        vote['options'] = [option_ids[0]]
+
+        time.sleep(1)
+        res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        assert res.status_code == 201
+
+        vote['options'] = [option_ids[1]]
+        res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        assert res.status_code == 403
+
+        res = self.app.get('/polls?code=%s' % (code))
+        assert res.status_code == 403
+
+    def test_vote_options(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        poll = generate_poll()
+        poll['select_max'] = 2
+        res = self.app.post('/polls', data=json.dumps(poll), headers=headers)
+        poll = json.loads(res.get_data())['data']['poll']
+        option_ids = [option['id'] for option in poll['options']]
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers=headers)
+        other_option_id = json.loads(res.get_data())['data']['poll']['options'][0]['id']
+        res = self.app.post('/members', data=json.dumps(generate_member()), headers=headers)
+        member_id = json.loads(res.get_data())['data']['member']['id']
+        res = self.app.post('/polls/%d/codes' % (poll['id']), data=json.dumps({'member_ids': [member_id]}), headers=headers)
+        code = json.loads(res.get_data())['data']['codes'][0]['code']
+        time.sleep(1)
+
+        url = '/polls/%d/votes' % (poll['id'])
+        invalid = [
+            (option_ids, 'There can at most be 2 options'),
+            ([], 'There must be at least 1 options'),
+            ([option_ids[0], option_ids[0]], 'The options must be unique'),
+            ([option_ids[0], other_option_id], 'One or more options are invalid'),
+            (['first'], 'The options must be a list of valid integers'),
+        ]
+        for options, message in invalid:
+            res = self.app.post(url, data=json.dumps({'code': code, 'options': options}), headers={'Content-Type': 'application/json'})
+            assert res.status_code == 400
+            assert json.loads(res.get_data())['data']['options'] == message
+            assert Vote.query.filter_by(poll_id=poll['id']).count() == 0
+
+        res = self.app.post(url, data=json.dumps({'code': code, 'options': option_ids[:2]}), headers={'Content-Type': 'application/json'})
+        assert res.status_code == 201
+        vote = json.loads(res.get_data())['data']['vote']
+        assert sorted(option['id'] for option in vote['options']) == sorted(option_ids[:2])
+
+    # A code used by another request after the vote was parsed is caught by
+    # the unique constraint.
+    def test_vote_race(self):
+        poll_id, option_ids, code = self.create_code()
+        time.sleep(1)
+        view = app.view_functions['post_votesByPollId']
+        parse = view.__globals__['parse_vote']
+        def parse_then_vote(json, poll):
+            result = parse(json, poll)
+            used = Code.query.filter_by(code=code).one()
+            db.engine.execute(Vote.__table__.insert(), code_id=used.id, poll_id=poll.id, member_id=used.member_id)
+            return result
+        view.__globals__['parse_vote'] = parse_then_vote
+        try:
+            vote = {'code': code, 'options': [option_ids[0]]}
+            res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        finally:
+            view.__globals__['parse_vote'] = parse
+        assert res.status_code == 403
+        assert json.loads(res.get_data())['data']['code'] == CODE_USED_ERROR
+        assert Vote.query.filter_by(poll_id=poll_id).count() == 1
+
+    # Codes given to the members by another request after parsing are caught
+    # by the unique constraint.
+    def test_codes_race(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers=headers)
+        poll_id = json.loads(res.get_data())['data']['poll']['id']
+        res = self.app.post('/members', data=json.dumps(generate_member()), headers=headers)
+        member_id = json.loads(res.get_data())['data']['member']['id']
+
+        view = app.view_functions['code']
+        parse = view.__globals__['parse_codes']
+        def parse_then_create(json, poll):
+            result = parse(json, poll)
+            db.engine.execute(Code.__table__.delete().where(Code.__table__.c.poll_id == poll.id))
+            db.engine.execute(Code.__table__.insert(), code=random_string(10), poll_id=poll.id, member_id=member_id)
+            return result
+        view.__globals__['parse_codes'] = parse_then_create
+        try:
+            res = self.app.post('/polls/%d/codes' % (poll_id), data=json.dumps({'member_ids': [member_id]}), headers=headers)
+            assert res.status_code == 400
+            assert json.loads(res.get_data())['data']['member_ids'] == CODE_EXISTS_ERROR
+
+            res = self.app.post('/polls/%d/codes?async=true' % (poll_id), data=json.dumps({'member_ids': [member_id]}), headers=headers)
+            job = json.loads(res.get_data())['data']['job']
+            assert job['status'] == 'failed'
+            assert job['error'] == CODE_EXISTS_ERROR
+        finally:
+            view.__globals__['parse_codes'] = parse
+        assert Code.query.filter_by(poll_id=poll_id).count() == 1
+
+    def test_group_codes(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers=headers)
+        poll_id = json.loads(res.get_data())['data']['poll']['id']
+        group = random_string(10)
+        for i in xrange(0, 3):
+            member = generate_member()
+            member['group'] = group
+            res = self.app.post('/members', data=json.dumps(member), headers=headers)
+            assert res.status_code == 201
+
+        res = self.app.post('/polls/%d/codes' % (poll_id), data=json.dumps({'group': group}), headers=headers)
+        assert res.status_code == 201
+        codes = json.loads(res.get_data())['data']['codes']
+        assert len(codes) == 3
+        assert len(set(code['code'] for code in codes)) == 3
+
+        # The number of queries doesn't depend on the number of codes.
+        single = generate_member()
+        self.app.post('/members', data=json.dumps(single), headers=headers)
+        other = self.app.post('/polls/%d/codes' % (poll_id), data=json.dumps({'group': single['group']}), headers=headers)
+        assert other.status_code == 201
+        assert res.headers['X-Query-Count'] == other.headers['X-Query-Count']
+
+        # Everyone in the group already has a code.
+        res = self.app.post('/polls/%d/codes' % (poll_id), data=json.dumps({'group': group}), headers=headers)
+        assert res.status_code == 400
+
+        res = self.app.post('/polls/%d/codes' % (poll_id), data=json.dumps({'member_ids': [1000]}), headers=headers)
+        assert res.status_code == 400
+
+        # Deleting a member who has a code doesn't hide the rest of a group.
+        res = self.app.delete('/members/%d' % (Code.query.filter_by(poll_id=poll_id).first().member_id), headers=headers)
+        assert res.status_code == 200
+        member = generate_member()
+        member['group'] = group
+        self.app.post('/members', data=json.dumps(member), headers=headers)
+        res = self.app.post('/polls/%d/codes' % (poll_id), data=json.dumps({'group': group}), headers=headers)
+        assert res.status_code == 201
+        assert len(json.loads(res.get_data())['data']['codes']) == 1
+
+    def test_list_votes(self):
+        poll_id, option_ids, code = self.create_code()
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password)}
+        res = self.app.get('/polls/%d/votes?limit=0' % (poll_id), headers=headers)
+        assert res.status_code == 400
+
+        time.sleep(1)
+        vote = {'code': code, 'options': [option_ids[0]]}
+        res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        assert res.status_code == 201
+        vote_id = json.loads(res.get_data())['data']['vote']['id']
+
+        res = self.app.get('/polls/%d/votes?limit=1' % (poll_id), headers=headers)
+        js = json.loads(res.get_data())
+        assert [vote['id'] for vote in js['data']['votes']] == [vote_id]
+        assert js['data']['next'] == None
+
+        res = self.app.get('/polls/%d/votes?after_id=%d' % (poll_id, vote_id), headers=headers)
+        js = json.loads(res.get_data())
+        assert not js['data']['votes']
+
+    def test_export_votes(self):
+        poll_id, option_ids, code = self.create_code()
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password)}
+        time.sleep(1)
+        vote = {'code': code, 'options': [option_ids[1]]}
+        res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        assert res.status_code == 201
+
+        res = self.app.get('/polls/%d/votes/export' % (poll_id), headers=headers)
+        assert res.status_code == 200
+        lines = res.get_data().splitlines()
+        assert len(lines) == 1
+        exported = json.loads(lines[0])
+        assert exported['code']['code'] == code
+        assert [option['id'] for option in exported['options']] == [option_ids[1]]
+
+        res = self.app.get('/polls/%d/votes/export?format=csv' % (poll_id), headers=headers)
+        assert res.status_code == 200
+        assert len(res.get_data().splitlines()) == 2
+
+        res = self.app.get('/polls/%d/votes/export?format=xml' % (poll_id), headers=headers)
+        assert res.status_code == 400
+
+        # Export jobs report a line per vote.
+        res = self.app.get('/polls/%d/votes/export?async=true' % (poll_id), headers=headers)
+        assert res.status_code == 202
+        job = json.loads(res.get_data())['data']['job']
+        assert job['total'] == 1
+        assert job['progress'] == 1
+
+    # The progress of a job is visible to other requests while it runs.
+    def test_job_progress(self):
+        seen = []
+        def work(progress):
+            progress(1, 2)
+            table = Job.__table__
+            seen.append(tuple(db.engine.execute(db.select([table.c.progress, table.c.total]).where(table.c.id == progress.job_id)).first()))
+            return None
+        job = jobs.submit(Organizer.query.first(), 'test', work)
+        assert seen == [(1, 2)]
+        assert Job.query.get(job.id).status == 'done'
+
+    def test_results(self):
+        poll_id, option_ids, code = self.create_code()
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password)}
+        time.sleep(1)
+        vote = {'code': code, 'options': [option_ids[2]]}
+        res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        assert res.status_code == 201
+
+        res = self.app.get('/polls/%d/results?by=group' % (poll_id), headers=headers)
+        assert res.status_code == 200
+        results = json.loads(res.get_data())['data']['results']
+        assert results['total_votes'] == 1
+        for option in results['options']:
+            if option['id'] == option_ids[2]:
+                assert option['votes'] == 1
+                assert sum(option['groups'].values()) == 1
+            else:
+                assert option['votes'] == 0
+                assert not option['groups']
+
+        # Voiding the vote is reflected in the live tallies.
+        res = self.app.get('/polls/%d/votes' % (poll_id), headers=headers)
+        vote_id = json.loads(res.get_data())['data']['votes'][0]['id']
+        res = self.app.delete('/polls/%d/votes/%d' % (poll_id, vote_id), headers=headers)
+        assert res.status_code == 200
+        res = self.app.get('/polls/%d/results' % (poll_id), headers=headers)
+        results = json.loads(res.get_data())['data']['results']
+        assert results['total_votes'] == 0
+        assert all(option['votes'] == 0 for option in results['options'])
+
+    # Voiding a vote of a poll without tallies rebuilds them without the vote.
+    def test_void_vote_without_tallies(self):
+        poll_id, option_ids, code = self.create_code()
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password)}
+        time.sleep(1)
+        vote = {'code': code, 'options': [option_ids[0]]}
+        res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        vote_id = json.loads(res.get_data())['data']['vote']['id']
+        tally.clear(poll_id)
+        db.session.commit()
+
+        res = self.app.delete('/polls/%d/votes/%d' % (poll_id, vote_id), headers=headers)
+        assert res.status_code == 200
+        assert Tally.query.filter_by(option_id=option_ids[0]).one().votes == 0
+
+    def test_list_members(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        group = random_string(10)
+        names = ['alpha_%d' % (i) for i in xrange(0, 3)] + ['beta']
+        for name in names:
+            member = generate_member()
+            member['name'] = name
+            member['group'] = group
+            self.app.post('/members', data=json.dumps(member), headers=headers)
+        self.app.post('/members', data=json.dumps(generate_member()), headers=headers)
+
+        res = self.app.get('/members?group=%s&name=alpha_&limit=2' % (group), headers=headers)
+        js = json.loads(res.get_data())
+        assert [member['name'] for member in js['data']['members']] == names[:2]
+        assert js['data']['next'] != None
+
+        res = self.app.get('/members?group=%s&name=alpha_&after_id=%d' % (group, js['data']['next']), headers=headers)
+        js = json.loads(res.get_data())
+        assert [member['name'] for member in js['data']['members']] == names[2:3]
+        assert js['data']['next'] == None
+
+        # Wildcards in the name only match themselves.
+        res = self.app.get('/members?name=%25', headers=headers)
+        js = json.loads(res.get_data())
+        assert not js['data']['members']
+
+    def test_not_modified(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers=headers)
+        poll_id = json.loads(res.get_data())['data']['poll']['id']
+        self.app.post('/members', data=json.dumps(generate_member()), headers=headers)
+
+        for url in ['/polls', '/polls/%d' % (poll_id), '/members']:
+            res = self.app.get(url, headers=headers)
+            assert res.status_code == 200
+            etag = res.headers['ETag']
+            conditional = dict(headers)
+            conditional['If-None-Match'] = etag
+            res = self.app.get(url, headers=conditional)
+            assert res.status_code == 304
+            assert not res.get_data()
+            assert res.headers['ETag'] == etag
+
+        # Changing the data changes the tag.
+        conditional = dict(headers)
+        conditional['If-None-Match'] = etag
+        self.app.post('/members', data=json.dumps(generate_member()), headers=headers)
+        res = self.app.get('/members', headers=conditional)
+        assert res.status_code == 200
+
+    # Editing a poll within the same second as the last read must still change
+    # the tags of the poll, the poll list and the voter's ballot.
+    def test_not_modified_after_edit(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        poll_id, option_ids, code = self.create_code()
+        urls = ['/polls', '/polls/%d' % (poll_id), '/polls?code=%s' % (code)]
+        etags = [self.app.get(url, headers=headers).headers['ETag'] for url in urls]
+
+        poll = generate_poll()
+        poll['options'] = ['Red', 'Green']
+        res = self.app.put('/polls/%d' % (poll_id), data=json.dumps(poll), headers=headers)
+        assert res.status_code == 200
+
+        for url, etag in zip(urls, etags):
+            conditional = dict(headers)
+            conditional['If-None-Match'] = etag
+            res = self.app.get(url, headers=conditional)
+            assert res.status_code == 200
+        options = json.loads(res.get_data())['data']['poll']['options']
+        assert [option['option'] for option in options] == ['Red', 'Green']
+
+    def test_json_encoding(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        poll = generate_poll()
+        res = self.app.post('/polls', data=json.dumps(poll), headers=headers)
+        body = res.get_data()
+        # Responses are compact and dates are in ISO 8601 format.
+        assert '\n' not in body and ', ' not in body
+        created = json.loads(body)['data']['poll']
+        assert created['start_time'] == poll['start_time']
+        assert created['end_time'] == poll['end_time']
+
+        for name in encoding.BACKENDS:
+            try:
+                dumps = encoding.BACKENDS[name]()
+            except ImportError:
+                continue
+            assert json.loads(dumps({'time': datetime(2015, 6, 1, 12, 30)})) == {'time': '2015-06-01T12:30:00'}
+
+    # Votes of deleted members are counted under a null group by every backend.
+    def test_results_of_deleted_member(self):
+        poll_id, option_ids, code = self.create_code()
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password)}
+        time.sleep(1)
+        vote = {'code': code, 'options': [option_ids[0]]}
+        res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        member_id = json.loads(res.get_data())['data']['vote']['member_id']
+        res = self.app.delete('/members/%d' % (member_id), headers=headers)
+        assert res.status_code == 200
+
+        try:
+            for name in encoding.BACKENDS:
+                try:
+                    encoding.use_backend(name)
+                except ImportError:
+                    continue
+                res = self.app.get('/polls/%d/results?by=group' % (poll_id), headers=headers)
+                assert res.status_code == 200
+                options = json.loads(res.get_data())['data']['results']['options']
+                groups = [option['groups'] for option in options if option['id'] == option_ids[0]][0]
+                assert groups == {'null': 1}
+        finally:
+            encoding.use_backend(app.config.get('JSON_BACKEND'))
+
+    def test_compression(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers=headers)
+        poll_id = json.loads(res.get_data())['data']['poll']['id']
+        url = '/polls/%d' % (poll_id)
+
+        # Small responses are sent as they are.
+        gzip_headers = dict(headers)
+        gzip_headers['Accept-Encoding'] = 'gzip'
+        res = self.app.get(url, headers=gzip_headers)
+        assert 'Content-Encoding' not in res.headers
+        assert 'Accept-Encoding' in res.headers['Vary']
+
+        app.config['COMPRESS_MIN_SIZE'] = 0
+        try:
+            plain = self.app.get(url, headers=headers)
+            assert 'Content-Encoding' not in plain.headers
+            res = self.app.get(url, headers=gzip_headers)
+            assert res.headers['Content-Encoding'] == 'gzip'
+            assert zlib.decompress(res.get_data(), 16 + zlib.MAX_WBITS) == plain.get_data()
+            # The compressed representation has its own ETag.
+            assert res.headers['ETag'] != plain.headers['ETag']
+            conditional = dict(gzip_headers)
+            conditional['If-None-Match'] = res.headers['ETag']
+            assert self.app.get(url, headers=conditional).status_code == 304
+
+            # Streamed responses are compressed as they are produced.
+            res = self.app.get('/polls/%d/votes/export' % (poll_id), headers=gzip_headers)
+            assert res.headers['Content-Encoding'] == 'gzip'
+            assert zlib.decompress(res.get_data(), 16 + zlib.MAX_WBITS) == ''
+        finally:
+            app.config['COMPRESS_MIN_SIZE'] = 1024
+
+    def test_import_members(self):
+        organizer = Organizer.query.first()
+        members = [generate_member() for i in xrange(0, 2)]
+        rows = [(2, members[0], None), (3, members[1], None), (4, dict(members[0]), None), (5, None, 'The organization name is missing')]
+        report = memberimport.import_members(organizer, rows)
+        assert report['created'] == 2
+        assert report['duplicate'] == 1
+        assert report['invalid'] == 1
+        assert [row['status'] for row in report['rows']] == ['created', 'created', 'duplicate', 'invalid']
+        member = Member.query.filter_by(name=members[1]['name']).one()
+        assert len(member.contacts) == len(members[1]['contacts'])
+
+        # Names that already exist are duplicates in later imports too.
+        report = memberimport.import_members(organizer, [(2, members[1], None)])
+        assert report['duplicate'] == 1
+
+    def test_sync_members(self):
+        organizer = Organizer.query.first()
+        # The member of the code isn't in the sheet but has a code.
+        self.create_code()
+        unchanged, updated, removed = [generate_member() for i in xrange(0, 3)]
+        memberimport.import_members(organizer, [(2, unchanged, None), (3, updated, None), (4, removed, None)])
+
+        updated = dict(updated, group=random_string(10))
+        new = generate_member()
+        rows = [(2, unchanged, None), (3, updated, None), (4, new, None), (5, None, 'The organization name is missing')]
+        report = memberimport.sync_members(organizer, rows)
+        statuses = dict((row['name'], row['status']) for row in report['rows'] if row['name'])
+        assert statuses[unchanged['name']] == 'unchanged'
+        assert statuses[updated['name']] == 'updated'
+        assert statuses[new['name']] == 'created'
+        assert statuses[removed['name']] == 'removed'
+        assert report['kept'] == 1
+        assert report['invalid'] == 1
+
+        assert Member.query.filter_by(name=removed['name']).first() == None
+        assert Member.query.filter_by(name=updated['name']).one().group == updated['group']
+        assert Member.query.filter_by(name=new['name']).first() != None
+        assert Member.query.count() == 4
+
+    def test_find_header(self):
+        header = ['Organisation', 'Stakeholder group', 'Contact person 1', 'Email address 1', 'Contact person 2', 'Email address 2']
+        sheet = FakeSheet([['Member list'], [], header,
+            ['Acme', 'Industry', 'Jane', 'jane@example.com'],
+            ['Acme', 'Industry', 'John', 'john@example.com']])
+        top_row, columns, missing = xlprsr.find_header(sheet)
+        assert top_row == 2
+        assert missing == []
+        members = list(xlprsr.iter_members(sheet, top_row, columns))
+        assert len(members) == 1
+        row, member, error = members[0]
+        assert error == None
+        assert member['name'] == 'Acme'
+        assert len(member['contacts']) == 2
+
+        # Without a complete header the closest row tells what is missing.
+        sheet = FakeSheet([header[:3]] + [['Acme']] * 100)
+        top_row, columns, missing = xlprsr.find_header(sheet)
+        assert top_row == -1
+        assert missing == ['emailaddress1', 'contactperson2', 'emailaddress2']
+
+        # The header is only looked for near the top.
+        sheet = FakeSheet([['Acme']] * xlprsr.HEADER_SEARCH_ROWS + [header])
+        top_row, columns, missing = xlprsr.find_header(sheet)
+        assert top_row == -1
+
+    # A member whose row became invalid in a synced sheet must not be removed.
+    def test_sync_keeps_invalid_members(self):
+        organizer = Organizer.query.first()
+        member = generate_member()
+        memberimport.import_members(organizer, [(1, member, None)])
+
+        invalid = dict(member, contacts=[])
+        report = memberimport.sync_members(organizer, [(1, invalid, 'At least one contact with an email address is required')])
+        assert report['invalid'] == 1
+        assert report['removed'] == 0
+        assert Member.query.filter_by(name=member['name']).first() != None
+
+    def test_background_codes(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers=headers)
+        poll_id = json.loads(res.get_data())['data']['poll']['id']
+        res = self.app.post('/members', data=json.dumps(generate_member()), headers=headers)
+        member_id = json.loads(res.get_data())['data']['member']['id']
+
+        res = self.app.post('/polls/%d/codes?async=true' % (poll_id), data=json.dumps({'member_ids': [member_id]}), headers=headers)
+        assert res.status_code == 202
+        job = json.loads(res.get_data())['data']['job']
+
+        res = self.app.get('/jobs/%d' % (job['id']), headers=headers)
+        assert res.status_code == 200
+        job = json.loads(res.get_data())['data']['job']
+        assert job['status'] == 'done'
+        assert job['progress'] == 1
+        assert len(job['result']['codes']) == 1
+
+        # Jobs are only visible to their organizer.
+        res = self.app.get('/jobs/%d' % (job['id']), headers={'Authorization': 'Basic ' + base64.b64encode(admin + ":" + password)})
+        assert res.status_code == 403
+
+    def test_email_codes(self):
+        server = RecordingSMTPServer(('localhost', 0), None)
+        thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+        thread.daemon = True
+        thread.start()
+        app.config['MAIL_SERVER'] = 'localhost'
+        app.config['MAIL_PORT'] = server.socket.getsockname()[1]
+        try:
+            poll_id, option_ids, code = self.create_code()
+            headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+
+            res = self.app.post('/polls/%d/emails' % (poll_id), data=json.dumps({'body': 'Hello $bogus'}), headers=headers)
+            assert res.status_code == 400
+            res = self.app.post('/polls/%d/emails' % (poll_id), data=json.dumps({'resend': 'false'}), headers=headers)
+            assert res.status_code == 400
+            res = self.app.post('/polls/%d/emails' % (poll_id), data=json.dumps(['subject']), headers=headers)
+            assert res.status_code == 400
+
+            res = self.app.post('/polls/%d/emails' % (poll_id), data=json.dumps({'subject': 'Vote now'}), headers=headers)
+            assert res.status_code == 202
+            job = json.loads(res.get_data())['data']['job']
+            assert job['status'] == 'done'
+            assert job['result'] == {'sent': 1, 'failed': 0}
+            assert len(server.messages) == 1
+            # The body is base64 encoded.
+            message = email.message_from_string(server.messages[0])
+            assert code in message.get_payload(decode=True)
+
+            res = self.app.get('/polls/%d/codes' % (poll_id), headers=headers)
+            codes = json.loads(res.get_data())['data']['codes']
+            assert codes[0]['email_status'] == 'sent'
+
+            # Codes are only sent once unless asked otherwise.
+            res = self.app.post('/polls/%d/emails' % (poll_id), data=json.dumps({}), headers=headers)
+            assert json.loads(res.get_data())['data']['job']['result'] == {'sent': 0, 'failed': 0}
+            assert len(server.messages) == 1
+        finally:
+            server.close()
+
+    def test_delete_poll(self):
+        poll_id, option_ids, code = self.create_code()
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password)}
+        time.sleep(1)
+        vote = {'code': code, 'options': [option_ids[0]]}
+        res = self.app.post('/polls/%d/votes' % (poll_id), data=json.dumps(vote), headers={'Content-Type': 'application/json'})
+        assert res.status_code == 201
+
+        res = self.app.delete('/polls/%d' % (poll_id), headers=headers)
+        assert res.status_code == 200
+        res = self.app.get('/polls/%d' % (poll_id), headers=headers)
+        assert res.status_code == 404
+        for model in [Option, Code, Vote, Tally]:
+            assert model.query.filter_by(poll_id=poll_id).count() == 0
+        assert db.session.query(vote_option).count() == 0
+
+    # The hot queries must be served by indexes.
+    def test_query_plans(self):
+        import indexes
+        assert indexes.table_scans() == []
+
+    # Listing endpoints must not issue queries per item.
+    def test_list_query_counts(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        counts = {}
+        for i in xrange(0, 3):
+            self.app.post('/polls', data=json.dumps(generate_poll()), headers=headers)
+            self.app.post('/members', data=json.dumps(generate_member()), headers=headers)
+            for url in ['/polls', '/members']:
+                res = self.app.get(url, headers=headers)
+                assert res.status_code == 200
+                counts.setdefault(url, set()).add(res.headers['X-Query-Count'])
+        for url in counts:
+            assert len(counts[url]) == 1
+
+    # Creates a poll, a member and a code for the member.
+    # Returns the poll id, the option ids and the code.
+    def create_code(self):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(organizer + ":" + password), 'Content-Type': 'application/json'}
+        res = self.app.post('/polls', data=json.dumps(generate_poll()), headers=headers)
+        poll = json.loads(res.get_data())['data']['poll']
+        res = self.app.post('/members', data=json.dumps(generate_member()), headers=headers)
+        member_id = json.loads(res.get_data())['data']['member']['id']
+        data = {}
+        data['member_ids'] = [member_id]
+        res = self.app.post('/polls/%d/codes' % (poll['id']), data=json.dumps(data), headers=headers)
+        code = str(json.loads(res.get_data())['data']['codes'][0]['code'])
+        return poll['id'], [option['id'] for option in poll['options']], code
+
+
+# A worksheet with the part of the xlrd sheet interface used by xlprsr.
+class FakeSheet(object):
+    def __init__(self, rows):
+        width = max(len(row) for row in rows)
+        self.rows = [list(row) + [''] * (width - len(row)) for row in rows]
+        self.nrows = len(self.rows)
+
+    def row_values(self, row):
+        return self.rows[row]
+
+    def row_types(self, row):
+        return [xlrd.XL_CELL_TEXT if value else xlrd.XL_CELL_EMPTY for value in self.rows[row]]
+
+# A local SMTP server that keeps the messages it receives.
+class RecordingSMTPServer(smtpd.SMTPServer):
+    def __init__(self, *args, **kwargs):
+        smtpd.SMTPServer.__init__(self, *args, **kwargs)
+        self.messages = []
 
-def generate_poll():
-    now = datetime.now()
-    # Add a second to be safe.
-    now = now + timedelta(seconds=1)
-    tomorrow = now + timedelta(days=1)
-
-    poll = {}
-    poll['question'] = random_string(20) + '?'
-    poll['start_time'] = now.isoformat()
-    poll['end_time'] = tomorrow.isoformat()
-    poll['select_min'] = 1
-    poll['select_max'] = 1
-    poll['options'] = ['Yes', 'No', 'Abstain']
-    return poll
-
-def generate_member():
-    member = {}
-    member['name'] = random_string(10)
-    member['group'] = random_string(10)
-    numcontacts = random.randint(1, 5)
-    member['contacts'] = []
-    for i in xrange(0, numcontacts):
-        contact = {}
-        contact['name'] = random_string(10)
-        contact['email'] = random_string(7) + '@example.com'
-        member['contacts'].append(contact)
-    return member
-
-
-def random_string(length):
-    return ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(length))
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(data)
 
 if __name__ == '__main__':
     generate_member()
@@ -0,0 +1,10 @@
+# Yields successive lists of at most size items from the given iterable.
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
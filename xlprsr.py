@@ -1,65 +1,56 @@
 import xlrd
+import re
 import sys
-import models
+
+# Cell Types: 0=Empty, 1=Text, 2=Number, 3=Date, 4=Boolean, 5=Error, 6=Blank.
+TEXT = xlrd.XL_CELL_TEXT
+
+# The header must be within this many rows from the top of the sheet.
+HEADER_SEARCH_ROWS = 50
+
+# The cleaned names of the header columns, in the order the columns are
+# returned by find_header.
+COLUMN_NAMES = ['organization', 'stakeholdergroup', 'contactperson1', 'emailaddress1', 'contactperson2', 'emailaddress2']
+
+SEPARATORS = re.compile(r'[\s_\-]+', re.UNICODE)
 
 # Delete all word-separating characters, make lowercase and write organization
 # with a z.
 def clean_string(string):
-    return ''.join(string.lower().replace('_', '').replace('-', '').replace('organis', 'organiz').split())
-
-def find_top_row(worksheet):
-    num_rows = worksheet.nrows - 1
-    num_cells = worksheet.ncols - 1
-    curr_row = -1
-    while curr_row < num_rows:
-        curr_row += 1
-        row = worksheet.row(curr_row)
-        values = []
-        curr_cell = -1
-        # Get all the text values into an array.
-        # Remove any word-separating characters.
-        while curr_cell < num_cells:
-            # Cell Types: 0=Empty, 1=Text, 2=Number, 3=Date, 4=Boolean, 5=Error, 6=Blank.
-            curr_cell += 1
-            cell_type = worksheet.cell_type(curr_row, curr_cell)
-            if cell_type == 1:
-                cell_value = worksheet.cell_value(curr_row, curr_cell)
-                # Be forgiving in terms of word seperators.
-                value = clean_string(cell_value)
-                values.append(value)
-        expected_values = ['organization', 'stakeholdergroup', 'contactperson1', 'contactperson2', 'emailaddress1', 'emailaddress2']
-        is_top = True
-        for ev in expected_values:
-            if ev not in values:
-                is_top = False
-                break
-        if is_top:
-            return curr_row
-    return -1
-
-def get_cols(worksheet, top_row):
-    num_cells = worksheet.ncols - 1
-    curr_cell = -1
-    columns = [None, None, None, None, None, None]
-    column_names = ['organization', 'stakeholdergroup', 'contactperson1', 'emailaddress1', 'contactperson2', 'emailaddress2']
-    while curr_cell < num_cells:
-        curr_cell += 1
-        cell_type = worksheet.cell_type(top_row, curr_cell)
-        if cell_type == 1:
-            cell_value = worksheet.cell_value(top_row, curr_cell)
-            value = clean_string(cell_value)
-            if value in column_names:
-                columns[column_names.index(value)] = curr_cell
-    return tuple(columns)
-            
-def parse_file(excelfile):
-    #script, filename = sys.argv
+    return SEPARATORS.sub('', string.lower()).replace('organis', 'organiz')
+
+# Looks for the header row within the first HEADER_SEARCH_ROWS rows and maps
+# the header names to columns in the same pass.
+# Returns a 3-tuple of the header row, a tuple of the column indexes in the
+# order of COLUMN_NAMES and a list of missing column names. If no header is
+# found, the row is -1, the columns are None and the missing columns are those
+# of the row that came closest.
+def find_header(worksheet):
+    missing = list(COLUMN_NAMES)
+    for curr_row in xrange(min(worksheet.nrows, HEADER_SEARCH_ROWS)):
+        values = worksheet.row_values(curr_row)
+        types = worksheet.row_types(curr_row)
+        columns = {}
+        for curr_cell, value in enumerate(values):
+            if types[curr_cell] != TEXT:
+                continue
+            # Be forgiving in terms of word seperators.
+            name = clean_string(value)
+            if name in COLUMN_NAMES and name not in columns:
+                columns[name] = curr_cell
+        if len(columns) == len(COLUMN_NAMES):
+            return curr_row, tuple(columns[name] for name in COLUMN_NAMES), []
+        if len(COLUMN_NAMES) - len(columns) < len(missing):
+            missing = [name for name in COLUMN_NAMES if name not in columns]
+    return -1, None, missing
 
-    #workbook = xlrd.open_workbook(filename)
-    workbook = xlrd.open_workbook(file_contents=excelfile.read())
+# Opens the uploaded workbook and returns the sheet with the contacts.
+def open_worksheet(excelfile):
+    # Only load the sheets that are actually used.
+    workbook = xlrd.open_workbook(file_contents=excelfile.read(), on_demand=True)
 
     # Use first sheet by default.
-    worksheet = workbook.sheets()[0]
+    worksheet = workbook.sheet_by_index(0)
 
     # If there's a sheet named 'All Contacts', use that.
     for sheetname in workbook.sheet_names():
@@ -67,47 +58,79 @@ def parse_file(excelfile):
         if 'all' in lower and 'contacts' in lower:
             worksheet = workbook.sheet_by_name(sheetname)
             break
+    return worksheet
 
-    top_row = find_top_row(worksheet)
-    name_col, group_col, cname1_col, email1_col, cname2_col, email2_col = get_cols(worksheet, top_row)
-
-    num_rows = worksheet.nrows - 1
-    curr_row = top_row
-    prev_name = ''
-    members = []
+# Yields a 3-tuple for every member in the sheet below the top row: the number
+# of the first row of the member, a dictionary with the member's name, group
+# and contacts, and an error message or None.
+# Consecutive rows with the same organization name belong to the same member.
+def iter_members(worksheet, top_row, columns):
+    name_col, group_col, cname1_col, email1_col, cname2_col, email2_col = columns
+    contact_cols = [(cname1_col, email1_col), (cname2_col, email2_col)]
     member = None
-    while curr_row < num_rows:
-        curr_row += 1
-        name = worksheet.cell_value(curr_row, name_col)
-        if name.lower() != prev_name.lower():
+    for curr_row in xrange(top_row + 1, worksheet.nrows):
+        # Read the whole row at once instead of cell by cell.
+        values = worksheet.row_values(curr_row)
+        types = worksheet.row_types(curr_row)
+        if all(t in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK) for t in types):
+            continue
+        if types[name_col] != TEXT or not values[name_col].strip():
             if member != None:
-                members.append(member)
-            #member = {}
-            #member['name'] = name
-            #member['group'] = worksheet.cell_value(curr_row, group_col)
-            #member['contacts'] = []
-            member = models.Member()
-            member.name = name
-            member.group = worksheet.cell_value(curr_row, group_col)
-            member.contacts = []
-
-        for tup in [(cname1_col, email1_col), (cname2_col, email2_col)]:
-            cname_col, email_col = tup
-            if worksheet.cell_type(curr_row, email_col) == 1:
-                #contact = {}
-                #contact['email'] = worksheet.cell_value(curr_row, email_col)
-                contact = models.Contact()
-                contact.email = worksheet.cell_value(curr_row, email_col)
-                if worksheet.cell_type(curr_row, cname_col) == 1:
-                    #contact['name'] = worksheet.cell_value(curr_row, cname_col)
-                    contact.name = worksheet.cell_value(curr_row, cname_col)
-                member.contacts.append(contact)
-        prev_name = name
+                yield finish_member(member)
+                member = None
+            yield curr_row + 1, None, 'The organization name is missing'
+            continue
+
+        name = values[name_col].strip()
+        if member == None or name.lower() != member[1]['name'].lower():
+            if member != None:
+                yield finish_member(member)
+            group = values[group_col] if types[group_col] == TEXT else ''
+            member = (curr_row + 1, {'name': name, 'group': group.strip(), 'contacts': []}, None)
+
+        contacts = member[1]['contacts']
+        for cname_col, email_col in contact_cols:
+            if email_col is None or types[email_col] != TEXT:
+                continue
+            contact = {'name': None, 'email': values[email_col].strip()}
+            if cname_col is not None and types[cname_col] == TEXT:
+                contact['name'] = values[cname_col].strip()
+            if contact['email'] and contact['email'] not in [c['email'] for c in contacts]:
+                contacts.append(contact)
     if member != None:
-        members.append(member)
-    return members
+        yield finish_member(member)
+
+# Marks members without any contacts as invalid.
+def finish_member(member):
+    row, data, error = member
+    if not data['contacts']:
+        return row, data, 'At least one contact with an email address is required'
+    return member
+
+# Returns a 2-tuple.
+# Either a generator of members as yielded by iter_members and None or None and
+# a dictionary of error messages.
+def parse_file(excelfile):
+    error = {}
+    try:
+        worksheet = open_worksheet(excelfile)
+    except xlrd.XLRDError, e:
+        error['excel_file'] = 'The file is not a valid Excel workbook'
+        return None, error
+
+    top_row, columns, missing = find_header(worksheet)
+    if top_row == -1:
+        error['excel_file'] = 'No header row with the required columns was found in the first %d rows' % (HEADER_SEARCH_ROWS)
+        error['missing_columns'] = missing
+        return None, error
+    return iter_members(worksheet, top_row, columns), None
 
 if __name__ == '__main__':
     script, filename = sys.argv
-    file = open(filename, 'r')
-    members = parse_file(file)
+    file = open(filename, 'rb')
+    members, error = parse_file(file)
+    if error:
+        print error
+    else:
+        for row, member, error in members:
+            print row, error or member